@@ -1,52 +1,214 @@
+import asyncio
+import hashlib
 import os
-from datetime import datetime, timedelta, timezone
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from uuid import UUID
 
-from dotenv import load_dotenv
+import bcrypt
+import jwt
+import orjson
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, insert, inspect, update
+from sqlalchemy.orm import Session, make_transient_to_detached
 
 from . import models, schemas
+from .config import get_settings
 from .database import get_db
 from .models import User, UserRole
 from .schemas import TokenData
-from .utils import get_or_create_secret_key
+from .utils import TTLCache, get_or_create_secret_key
 
-load_dotenv()
+settings = get_settings()
+ACCESS_TOKEN_EXPIRE_SECONDS = settings.access_token_expire_minutes * 60
 
-ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+# JWT signing key, loaded once at startup by load_secret_key
+SECRET_KEY = None
 
+# Only used to verify legacy hashes that bcrypt.checkpw does not handle directly
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Tokens without an expiry or a user_id are rejected during decoding
+_JWT_OPTIONS = {"require": ["exp", "user_id"]}
+
+
+class OrjsonJWT(jwt.PyJWT):
+    """
+    PyJWT with its payload serialized and parsed by orjson instead of the json module.
+    """
+
+    def _encode_payload(self, payload, headers=None, json_encoder=None) -> bytes:
+        return orjson.dumps(payload)
+
+    def _decode_payload(self, decoded: dict):
+        try:
+            payload = orjson.loads(decoded["payload"])
+        except orjson.JSONDecodeError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}") from e
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
+
+
+_jwt = OrjsonJWT()
+
+# Bounds concurrent bcrypt work so login spikes cannot starve the default threadpool
+_BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
+
+# Verified against when the email is unknown, so a miss costs as much as a wrong password
+_DUMMY_HASH = bcrypt.hashpw(b"x", bcrypt.gensalt(rounds=settings.bcrypt_rounds)).decode()
+
+TOKEN_CACHE_TTL_SECONDS = 60
+# Validated tokens, keyed by the SHA-256 of the raw token, mapped to a snapshot of the user's columns
+token_cache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+USER_CACHE_TTL_SECONDS = 30
+USER_BY_EMAIL = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+USER_BY_ID = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+
 
 def verify_password(plain_password, hashed_password):
+    if hashed_password.startswith("$2b$"):
+        return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
     return pwd_context.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=settings.bcrypt_rounds)).decode()
+
+
+async def verify_password_async(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_BCRYPT_POOL, verify_password, plain_password, hashed_password)
 
 
-def create_access_token(data: dict, expires_delta: timedelta = None, db: Session = Depends(get_db)):
-    to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=60))
-    to_encode.update({"exp": expire})
-    secret_key = get_or_create_secret_key(db)
-    encoded_jwt = jwt.encode(to_encode, secret_key, algorithm=ALGORITHM)
+async def get_password_hash_async(password):
+    """
+    Hashes a password on the bcrypt pool, so the event loop and the request threadpool stay free.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_BCRYPT_POOL, get_password_hash, password)
+
+
+def load_secret_key(db: Session):
+    """
+    Loads the JWT signing key into memory, so issuing and validating tokens never queries the database for it.
+    """
+    global SECRET_KEY
+    SECRET_KEY = get_or_create_secret_key(db)
+
+
+def create_access_token(data: dict, expires_delta: timedelta = None):
+    expires_in = int(expires_delta.total_seconds()) if expires_delta else ACCESS_TOKEN_EXPIRE_SECONDS
+    to_encode = {**data, "exp": int(time.time()) + expires_in}
+    encoded_jwt = _jwt.encode(to_encode, SECRET_KEY, algorithm=settings.algorithm)
     return encoded_jwt
 
 
+def snapshot_user(user: User) -> dict:
+    """
+    Copies the column values of a user so they can be cached outside the session.
+    """
+    return {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+
+
+def restore_user(db: Session, snapshot: dict) -> User:
+    """
+    Attaches a cached user snapshot to the session without querying the database.
+    """
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+
+def cache_user(user: User) -> dict:
+    """
+    Stores a user snapshot in both the email and the user_id lookup caches.
+    """
+    snapshot = snapshot_user(user)
+    USER_BY_EMAIL.set(user.email, snapshot)
+    USER_BY_ID.set(user.user_id, snapshot)
+    return snapshot
+
+
+def invalidate_cached_user(user_id):
+    """
+    Drops every cached token and lookup that resolves to the given user.
+    """
+    token_cache.pop_where(lambda snapshot: snapshot["user_id"] == user_id)
+    USER_BY_EMAIL.pop_where(lambda snapshot: snapshot["user_id"] == user_id)
+    USER_BY_ID.pop(user_id)
+
+
 def get_user(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+    snapshot = USER_BY_EMAIL.get(email)
+    if snapshot is not None:
+        return restore_user(db, snapshot)
+
+    user = db.query(User).filter(User.email == email).first()
+    if user:
+        cache_user(user)
+    return user
+
+
+def get_user_by_id(db: Session, user_id):
+    try:
+        user_uuid = user_id if isinstance(user_id, UUID) else UUID(user_id)
+    except ValueError:
+        return None
+
+    snapshot = USER_BY_ID.get(user_uuid)
+    if snapshot is not None:
+        return restore_user(db, snapshot)
+
+    user = db.query(User).filter(User.user_id == user_uuid).first()
+    if user:
+        cache_user(user)
+    return user
+
+
+def email_registered(db: Session, email: str) -> bool:
+    return db.query(exists().where(User.email == email)).scalar()
+
+
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: str):
+    """
+    Inserts a user and reads the stored row back through RETURNING, instead of refreshing it after the commit.
+    """
+    new_user = db.execute(insert(User).values(
+        first_name=user.first_name,
+        last_name=user.last_name,
+        email=user.email,
+        hashed_password=hashed_password
+    ).returning(User)).scalar_one()
+    # Built before the commit, which would expire the returned row
+    user_out = schemas.UserOut.model_validate(new_user)
+    db.commit()
+    return user_out
 
 
 def authenticate_user(db: Session, email: str, password: str):
     user = get_user(db, email)
-    if not user or not verify_password(password, user.hashed_password):
+    if not user:
+        verify_password(password, _DUMMY_HASH)
+        return False
+    if not verify_password(password, user.hashed_password):
+        return False
+    return user
+
+
+async def authenticate_user_async(db: Session, email: str, password: str):
+    """
+    Authenticates a user without blocking the event loop on the database lookup or the bcrypt verify.
+    """
+    user = await run_in_threadpool(get_user, db, email)
+    hashed_password = user.hashed_password if user else _DUMMY_HASH
+    if not await verify_password_async(password, hashed_password) or not user:
         return False
     return user
 
@@ -58,18 +220,25 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+    cache_key = hashlib.sha256(token.encode()).digest()
+    cached_user = token_cache.get(cache_key)
+    if cached_user is not None:
+        return restore_user(db, cached_user)
+
     try:
-        payload = jwt.decode(token, get_or_create_secret_key(db), algorithms=[ALGORITHM])
-        user_id: str = payload.get("user_id")
-        if user_id is None:
-            raise credentials_exception
-        token_data = TokenData(user_id=user_id)
-    except JWTError:
+        payload = _jwt.decode(token, SECRET_KEY, algorithms=[settings.algorithm], options=_JWT_OPTIONS)
+    except jwt.PyJWTError:
         raise credentials_exception
+    token_data = TokenData(user_id=payload["user_id"])
 
-    user = db.query(User).filter(User.user_id == token_data.user_id).first()
+    user = get_user_by_id(db, token_data.user_id)
     if user is None:
         raise credentials_exception
+
+    # Never cache a token for longer than it remains valid
+    ttl = min(payload["exp"] - time.time(), TOKEN_CACHE_TTL_SECONDS)
+    if ttl > 0:
+        token_cache.set(cache_key, snapshot_user(user), ttl)
     return user
 
 
@@ -80,25 +249,39 @@ def get_current_admin_user(current_user: User = Depends(get_current_user)):
 
 
 def update_user_profile(db: Session, db_user: models.User, user: schemas.UserUpdateProfile):
-    db_user.first_name = user.first_name
-    db_user.last_name = user.last_name
-    db_user.email = user.email
+    """
+    Updates a user's profile and reads the stored row back through RETURNING, instead of refreshing it.
+    Resubmitting the current profile unchanged writes nothing.
+    """
+    if (db_user.first_name, db_user.last_name, db_user.email) == (user.first_name, user.last_name, user.email):
+        return schemas.UserOut.model_validate(db_user)
+
+    user_id = db_user.user_id
+    updated_user = db.execute(update(User).where(User.user_id == user_id).values(
+        first_name=user.first_name,
+        last_name=user.last_name,
+        email=user.email
+    ).returning(User)).scalar_one()
+    # Built before the commit, which would expire the returned row
+    user_out = schemas.UserOut.model_validate(updated_user)
     db.commit()
-    db.refresh(db_user)
-    return schemas.UserOut(
-        user_id=str(db_user.user_id),
-        first_name=db_user.first_name,
-        last_name=db_user.last_name,
-        email=db_user.email,
-        enabled=db_user.enabled,
-        role=db_user.role
-    )
+    invalidate_cached_user(user_id)
+    return user_out
 
 
-def change_user_password(db: Session, db_user: models.User, old_password: str, new_password: str):
-    if not verify_password(old_password, db_user.hashed_password):
-        raise HTTPException(status_code=400, detail="Old password is incorrect")
-    db_user.hashed_password = get_password_hash(new_password)
+def save_user_password(db: Session, db_user: models.User, hashed_password: str):
+    user_id = db_user.user_id
+    db.execute(update(User).where(User.user_id == user_id).values(hashed_password=hashed_password))
     db.commit()
-    db.refresh(db_user)
+    invalidate_cached_user(user_id)
+
+
+async def change_user_password(db: Session, db_user: models.User, old_password: str, new_password: str):
+    """
+    Verifies the old password and stores the hash of the new one, with the bcrypt work on the bcrypt pool.
+    """
+    if not await verify_password_async(old_password, db_user.hashed_password):
+        raise HTTPException(status_code=400, detail="Old password is incorrect")
+    hashed_password = await get_password_hash_async(new_password)
+    await run_in_threadpool(save_user_password, db, db_user, hashed_password)
     return {"message": "Password updated successfully"}
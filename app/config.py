@@ -0,0 +1,65 @@
+from functools import lru_cache
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    """
+    Application configuration, read once from the environment and the .env file.
+    """
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_ignore_empty=True,
+        extra="ignore",
+        protected_namespaces=("settings_",)
+    )
+
+    # Database configuration
+    database_url: str
+    database_username: str
+    database_password: str
+    database_name: str
+    # Connections kept open per worker process, extra connections allowed under bursts, and seconds to wait for one
+    database_pool_size: int = 20
+    database_max_overflow: int = 40
+    database_pool_timeout: int = 30
+    # Threads FastAPI runs sync endpoints and blocking calls on; sized to the database connection pool
+    worker_threads: int = 60
+
+    # Directories
+    chromadb_persist_directory: str = "app/chroma_db"
+    documents_directory: str = "app/documents"
+    semantic_cache_directory: str = "app/semantic_cache"
+
+    # JWT configuration
+    algorithm: str = "HS256"
+    access_token_expire_minutes: int = 259200
+    bcrypt_rounds: int = 12
+
+    # Ollama configuration
+    ollama_url: str = "http://localhost:11434"
+    model_name: str = "llama3.1:8b-instruct-q4_1"
+    embedding_model_name: str = "nomic-embed-text"
+    # How long Ollama keeps the models loaded after a request
+    ollama_keep_alive: str = "24h"
+    # Comma-separated list of Ollama instances to spread embedding batches over; defaults to ollama_url
+    ollama_embed_urls: str = ""
+    ollama_embed_batch_size: int = 64
+    ollama_embed_concurrency: int = 4
+
+    # Number of past turns sent to the model with each message
+    history_max_turns: int = 20
+    # Estimated token budget for that history
+    history_max_tokens: int = 1024
+
+    # Semantic cache of responses to standalone questions
+    semantic_cache_threshold: float = 0.92
+    semantic_cache_ttl_seconds: int = 86400
+    semantic_cache_max_entries: int = 10_000
+    # How often caches with new entries are written to disk, so a crash loses at most this much
+    semantic_cache_save_interval_seconds: int = 300
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
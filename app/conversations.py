@@ -1,60 +1,215 @@
+import asyncio
+import contextlib
 import datetime
 import hashlib
 import logging
 import os
 import time
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
 from uuid import uuid4, UUID
 
-from fastapi import HTTPException, UploadFile
+import numpy as np
+from fastapi import BackgroundTasks, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from langchain.prompts import PromptTemplate
-from langchain_chroma import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_community.llms.ollama import Ollama
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.outputs import LLMResult
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from sqlalchemy import exists, func, insert, update
 from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
 
-from .models import Conversation, Message, Document
-from .rag_processing import process_and_store_documents
-from .utils import ASSISTANT_UUID
+from .config import get_settings
+from .database import session_scope
+from .models import Conversation, ConversationDocument, Message, Document
+from .rag_processing import (
+    collection_has_vectors,
+    copy_document_vectors,
+    embeddings,
+    get_collection,
+    has_vectors_cache,
+    process_and_store_documents
+)
+from . import semantic_cache
+from .utils import ASSISTANT_UUID, TTLCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://192.168.4.141:11434")
-MODEL_NAME = os.getenv("MODEL_NAME")
-EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "nomic-embed-text")
-CHROMADB_PERSIST_DIRECTORY = os.getenv("CHROMADB_PERSIST_DIRECTORY", "app/chroma_db")
-DOCUMENTS_DIRECTORY = os.getenv("DOCUMENTS_DIRECTORY", "app/documents")
+settings = get_settings()
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+RETRIEVAL_K = 3
+TITLE_MAX_TOKENS = 24
+
+# Only the most recent turns are sent to the model, one user and one AI message each
+HISTORY_MAX_MESSAGES = settings.history_max_turns * 2
+HISTORY_CACHE_TTL_SECONDS = 600
+# Message history per conversation, extended with each new turn instead of being reloaded from the database
+history_cache = TTLCache(maxsize=1024, ttl=HISTORY_CACHE_TTL_SECONDS)
+
+# Embeds retrieval queries while a turn's database work is still running
+_QUERY_EMBEDDING_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="query-embedding")
 
 ollama_client = Ollama(
-    base_url=OLLAMA_URL,
-    model=MODEL_NAME
+    base_url=settings.ollama_url,
+    model=settings.model_name,
+    keep_alive=settings.ollama_keep_alive
+)
+
+# Titles are a single short line, so generation is capped and stops at the first newline
+title_client = Ollama(
+    base_url=settings.ollama_url,
+    model=settings.model_name,
+    num_predict=TITLE_MAX_TOKENS,
+    temperature=0.2,
+    stop=["\n"],
+    keep_alive=settings.ollama_keep_alive
+)
+
+# Prompt templates are built once at import; only their variables change per call
+TITLE_PROMPT_TEMPLATE = PromptTemplate(
+    template="Generate a short 3-4 word title with an emoji at the start of the title for a conversation based on the following messages. Print ONLY the title.\n"
+             "User: {user_message}\n"
+             "AI: {ai_response}\n"
+             "Title:",
+    input_variables=["user_message", "ai_response"]
+)
+
+SYSTEM_PROMPT = (
+    "You are Home AI assistant. Your job is to assist house members for question-answering tasks. "
+    "Your native language is English, but you can speak other languages too."
+)
+CONTEXT_PROMPT = (
+    "Use the following pieces of retrieved context to answer the question. "
+    "If you don't know the answer, say that you don't know.\n\n"
+    "Documents:\n"
 )
 
+# The system prompt is constant, so the prompt only changes at its tail and Ollama can reuse its cached prefix
+CHAT_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages(
+    [
+        ("system", SYSTEM_PROMPT),
+        MessagesPlaceholder(variable_name="messages"),
+    ]
+)
+CHAT_CHAIN = CHAT_PROMPT_TEMPLATE | ollama_client
+
 
-def upload_user_documents(db: Session, user_id: str, files: List[UploadFile]):
+class PreparedTurn(NamedTuple):
+    """
+    Everything a conversation turn needs from the database and the vector stores, gathered before generation starts.
+    """
+    context_prompt: Optional[str]
+    message_history: List[HumanMessage]
+    needs_title: bool
+    cached_response: Optional[str]
+    cache_embedding: Optional[np.ndarray]
+
+
+class OllamaUsageHandler(BaseCallbackHandler):
+    """
+    Captures the token count Ollama reports with the final chunk of a generation.
+    """
+
+    def __init__(self):
+        self.eval_count = None
+
+    def on_llm_end(self, response: LLMResult, **kwargs):
+        generation_info = response.generations[0][0].generation_info or {}
+        self.eval_count = generation_info.get("eval_count")
+
+
+def warm_up_models():
+    """
+    Loads the chat and embedding models into Ollama so the first request does not pay for it.
+    """
+    try:
+        embeddings.embed_query("warmup")
+        ollama_client.invoke("ok", num_predict=1)
+    except Exception as e:
+        logger.warning(f"Failed to warm up Ollama models: {e}")
+
+
+def save_upload(upload_file: UploadFile, file_path: str):
+    """
+    Streams a spooled upload to disk in chunks, hashing it in the same pass.
+    Returns the sha256 checksum and the size in bytes.
+    """
+    sha256 = hashlib.sha256()
+    # Reuse one buffer for every chunk, the same way hashlib.file_digest does, instead of allocating bytes per read
+    buffer = bytearray(UPLOAD_CHUNK_SIZE)
+    view = memoryview(buffer)
+    written = 0
+    with open(file_path, 'wb') as f:
+        while size := upload_file.file.readinto(buffer):
+            sha256.update(view[:size])
+            f.write(view[:size])
+            written += size
+    return sha256.hexdigest(), written
+
+
+def remove_files(file_paths: List[str]):
+    """
+    Removes files, ignoring the ones that do not exist.
+    """
+    for file_path in file_paths:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path)
+
+
+def get_documents_by_checksum(db: Session, user_id: UUID, checksums: List[str]):
+    """
+    Returns the user's documents matching any of the checksums, keyed by checksum.
+    """
+    documents = db.query(Document).filter(
+        Document.user_id == user_id,
+        Document.checksum.in_(set(checksums))
+    ).all()
+    return {document.checksum: document for document in documents}
+
+
+async def upload_user_documents(db: Session, background_tasks: BackgroundTasks, user_id: UUID,
+                                files: List[UploadFile]):
     """
     Handles document uploads for a user, without requiring a conversation.
+    Blocking file and database work runs in the threadpool so the event loop stays free, and the new documents
+    are embedded in the background once the response has been sent.
     """
-    user_documents_dir = os.path.join(DOCUMENTS_DIRECTORY, user_id)
-    os.makedirs(user_documents_dir, exist_ok=True)
+    user_documents_dir = os.path.join(settings.documents_directory, str(user_id))
+    await run_in_threadpool(os.makedirs, user_documents_dir, exist_ok=True)
 
     document_instances = []
     existing_documents_details = []
 
-    for upload_file in files:
-        file_contents = upload_file.file.read()
-        checksum = hashlib.sha256(file_contents).hexdigest()
-
-        existing_document = db.query(Document).filter(
-            Document.user_id == user_id,
-            Document.checksum == checksum
-        ).first()
+    # Generate the file names in the format {document_id}_{file_name}.{extension}
+    file_paths = [os.path.join(user_documents_dir, f"{uuid4()}_{upload_file.filename}") for upload_file in files]
+    # Hash and write every file concurrently, each to a temporary path that only gets its final name once the
+    # checksum is known to be new. hashlib and file writes release the GIL, so the threads overlap.
+    saved_uploads = await asyncio.gather(*(
+        run_in_threadpool(save_upload, upload_file, f"{file_path}.part")
+        for upload_file, file_path in zip(files, file_paths)
+    ), return_exceptions=True)
+    failed_upload = next((result for result in saved_uploads if isinstance(result, BaseException)), None)
+    if failed_upload is not None:
+        # Every write has finished by now, so no partial file is left behind
+        await run_in_threadpool(remove_files, [f"{file_path}.part" for file_path in file_paths])
+        logger.error(f"Failed to save uploaded documents: {failed_upload}")
+        raise HTTPException(status_code=500, detail="Failed to save documents.")
+
+    # One query finds every file that is already stored; files repeated within this batch are caught by adding
+    # each new document to the same lookup
+    existing_by_checksum = await run_in_threadpool(
+        get_documents_by_checksum, db, user_id, [checksum for checksum, _ in saved_uploads]
+    )
+    for upload_file, file_path, (checksum, file_size_bytes) in zip(files, file_paths, saved_uploads):
+        temp_file_path = f"{file_path}.part"
+        existing_document = existing_by_checksum.get(checksum)
 
         if existing_document:
+            await run_in_threadpool(os.remove, temp_file_path)
             logger.info(f"Document {upload_file.filename} already exists for user {user_id}. Skipping upload.")
             existing_documents_details.append({
                 "id": str(existing_document.id),
@@ -65,16 +220,10 @@ def upload_user_documents(db: Session, user_id: str, files: List[UploadFile]):
             })
             continue
 
-        # Generate the file name in the format {document_id}_{file_name}.{extension}
-        new_file_name = f"{uuid4()}_{upload_file.filename}"
-        file_path = os.path.join(user_documents_dir, new_file_name)
-
-        with open(file_path, 'wb') as f:
-            f.write(file_contents)
-
-        file_size_bytes = os.path.getsize(file_path)
+        await run_in_threadpool(os.rename, temp_file_path, file_path)
 
         new_document = Document(
+            id=uuid4(),
             user_id=user_id,
             file_name=upload_file.filename,
             file_path=file_path,
@@ -82,21 +231,39 @@ def upload_user_documents(db: Session, user_id: str, files: List[UploadFile]):
             size=file_size_bytes,  # Save size in bytes
             checksum=checksum
         )
-        db.add(new_document)
-        db.flush()
-
-        db.commit()
-        db.refresh(new_document)
+        existing_by_checksum[checksum] = new_document
         document_instances.append(new_document)
 
+    # The new rows are inserted together when store_uploaded_documents commits
+    db.add_all(document_instances)
+
     if not document_instances and not existing_documents_details:
         return {"message": "No new documents were uploaded."}
 
-    try:
-        process_and_store_documents(document_instances, user_id)
-    except Exception as e:
-        logger.error(f"Failed to process documents: {e}")
-        raise HTTPException(status_code=500, detail="Failed to process documents.")
+    return await run_in_threadpool(
+        store_uploaded_documents, db, background_tasks, user_id, document_instances, existing_documents_details
+    )
+
+
+def store_uploaded_documents(db: Session, background_tasks: BackgroundTasks, user_id: UUID,
+                             document_instances: List[Document], existing_documents_details: List[dict]):
+    """
+    Commits the new documents, schedules their embedding, and returns the details of every uploaded document.
+    """
+    if document_instances:
+        new_document_ids = [doc.id for doc in document_instances]
+        new_file_paths = [doc.file_path for doc in document_instances]
+        try:
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            # Without their rows the stored files would never be listed or deleted
+            remove_files(new_file_paths)
+            logger.error(f"Failed to save documents: {e}")
+            raise HTTPException(status_code=500, detail="Failed to save documents.")
+        # Reload the committed rows with one query instead of refreshing them one by one
+        document_instances = db.query(Document).filter(Document.id.in_(new_document_ids)).all()
+        background_tasks.add_task(index_uploaded_documents, document_instances, user_id)
 
     new_documents_details = [
         {
@@ -112,7 +279,66 @@ def upload_user_documents(db: Session, user_id: str, files: List[UploadFile]):
     return new_documents_details + existing_documents_details
 
 
-def delete_document(db: Session, document_id: str, user_id: str):
+def get_indexed_copies(user_id: UUID, checksums: List[str]):
+    """
+    Returns, for each checksum, the user, id and chunk count of another user's fully indexed document with the
+    same content. Documents still being indexed have no chunk count yet, so they are never copied from.
+    """
+    with session_scope() as db:
+        copies = db.query(Document.checksum, Document.user_id, Document.id, Document.chunk_count).filter(
+            Document.checksum.in_(set(checksums)),
+            Document.user_id != user_id,
+            Document.chunk_count > 0
+        ).order_by(Document.upload_time.desc()).all()
+    return {checksum: (copy_user_id, str(copy_id), chunk_count)
+            for checksum, copy_user_id, copy_id, chunk_count in copies}
+
+
+def record_chunk_counts(chunk_counts: dict):
+    """
+    Marks documents as fully indexed by storing how many chunks each one has in Chroma.
+    """
+    if not chunk_counts:
+        return
+    with session_scope() as db:
+        # ORM bulk UPDATE by primary key: one executemany, with no rows loaded
+        db.execute(update(Document), [
+            {"id": document_id, "chunk_count": chunk_count} for document_id, chunk_count in chunk_counts.items()
+        ])
+
+
+def index_uploaded_documents(documents: List[Document], user_id: UUID):
+    """
+    Loads, splits and embeds newly uploaded documents after the upload response has been sent.
+    Documents whose content another user already indexed in full reuse that user's chunks and embeddings instead.
+    """
+    try:
+        indexed_copies = get_indexed_copies(user_id, [document.checksum for document in documents])
+        chunk_counts = {}
+        documents_to_embed = []
+        try:
+            for document in documents:
+                indexed_copy = indexed_copies.get(document.checksum)
+                if indexed_copy is not None and copy_document_vectors(*indexed_copy, document, user_id):
+                    chunk_counts[document.id] = indexed_copy[2]
+                else:
+                    documents_to_embed.append(document)
+        finally:
+            # Copied vectors are already stored, so they count as indexed even if a later copy or the embedding fails
+            record_chunk_counts(chunk_counts)
+
+        embedded_counts = process_and_store_documents(documents_to_embed, user_id)
+        record_chunk_counts(embedded_counts)
+        chunk_counts.update(embedded_counts)
+        if len(chunk_counts) < len(documents):
+            logger.warning("Indexed %d of %d uploaded documents of user %s; could not process: %s",
+                           len(chunk_counts), len(documents), user_id,
+                           ", ".join(document.file_name for document in documents if document.id not in chunk_counts))
+    except Exception as e:
+        logger.error(f"Failed to process documents of user {user_id}: {e}")
+
+
+def delete_document(db: Session, document_id: UUID, user_id: UUID):
     """
     Deletes a document from storage and ChromaDB, and removes it from conversations.
     """
@@ -127,33 +353,14 @@ def delete_document(db: Session, document_id: str, user_id: str):
     if os.path.exists(document.file_path):
         os.remove(document.file_path)
 
-    embeddings = OllamaEmbeddings(
-        base_url=OLLAMA_URL,
-        model=EMBEDDING_MODEL_NAME
-    )
-    vectorstore = Chroma(
-        collection_name=user_id,
-        embedding_function=embeddings,
-        persist_directory=CHROMADB_PERSIST_DIRECTORY,
-    )
+    # Chroma filters and deletes the chunks itself, so their ids never have to be fetched
+    get_collection(user_id).delete(where={"document_id": str(document_id)})
+    # The collection may be empty now, so the next turn has to count it again
+    has_vectors_cache.pop(user_id)
 
-    results = vectorstore._collection.get(
-        where={"document_id": document_id}
-    )
-    ids_to_delete = results['ids']
-
-    if ids_to_delete:
-        vectorstore.delete(ids=ids_to_delete)
-    else:
-        logger.warning(f"No embeddings found for document_id {document_id}")
-
-    conversations_to_update = db.query(Conversation).filter(
-        Conversation.user_id == user_id,
-        Conversation.selected_document_ids.any(UUID(document_id))
-    ).all()
-
-    for conversation in conversations_to_update:
-        conversation.selected_document_ids.remove(UUID(document_id))
+    db.query(ConversationDocument).filter(
+        ConversationDocument.document_id == document.id
+    ).delete(synchronize_session=False)
 
     db.delete(document)
     db.commit()
@@ -161,7 +368,7 @@ def delete_document(db: Session, document_id: str, user_id: str):
     return {"message": "Document deleted successfully."}
 
 
-def list_user_documents(db: Session, user_id: str):
+def list_user_documents(db: Session, user_id: UUID):
     """
     Lists all documents uploaded by a user.
     """
@@ -171,31 +378,60 @@ def list_user_documents(db: Session, user_id: str):
     return documents
 
 
-def create_ollama_client():
-    return Ollama(
-        base_url=OLLAMA_URL,
-        model=MODEL_NAME
+def get_conversation_messages(db: Session, conversation_id: UUID, user_id: UUID, limit: int = HISTORY_MAX_MESSAGES):
+    """
+    Retrieves the most recent messages in a conversation, oldest first
+    """
+    # The cache holds the last HISTORY_MAX_MESSAGES messages, so it can only serve windows up to that size
+    if limit <= HISTORY_MAX_MESSAGES:
+        cached_history = history_cache.get(conversation_id)
+        if cached_history is not None:
+            return list(cached_history[-limit:])
+
+    rows = db.query(Message.sender_id, Message.content).filter(
+        Message.conversation_id == conversation_id
+    ).order_by(Message.timestamp.desc()).limit(max(limit, HISTORY_MAX_MESSAGES)).all()
+    rows.reverse()
+
+    # Only the sender and content columns are loaded, so no ORM objects are built per message
+    history = tuple(
+        HumanMessage(content=content) if sender_id == user_id else AIMessage(content=content)
+        for sender_id, content in rows
     )
+    history_cache.set(conversation_id, history[-HISTORY_MAX_MESSAGES:])
+    return list(history[-limit:])
+
 
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text, which is close enough to budget a prompt
+    return len(text) // 4 + 1
 
-def get_conversation_messages(db: Session, conversation_id: str, user_id: str):
+
+def trim_history(message_history: List[HumanMessage], max_tokens: int) -> List[HumanMessage]:
     """
-    Retrieves all messages in a conversation
+    Keeps the most recent messages that fit in the token budget, estimated without a tokenizer or an LLM call.
     """
-    messages = db.query(Message).filter(
-        Message.conversation_id == conversation_id
-    ).order_by(Message.timestamp.asc()).all()
+    start = len(message_history)
+    while start > 0:
+        cost = estimate_tokens(message_history[start - 1].content)
+        if cost > max_tokens:
+            break
+        max_tokens -= cost
+        start -= 1
+    return message_history[start:]
 
-    history = []
-    for msg in messages:
-        if str(msg.sender_id) == user_id:
-            history.append(HumanMessage(content=msg.content))
-        else:
-            history.append(AIMessage(content=msg.content))
-    return history
+
+def append_to_history_cache(conversation_id: UUID, user_message: str, ai_response: str):
+    """
+    Adds a finished turn to the cached history of a conversation, if it is cached.
+    """
+    history = history_cache.get(conversation_id)
+    if history is not None:
+        history = history + (HumanMessage(content=user_message), AIMessage(content=ai_response))
+        history_cache.set(conversation_id, history[-HISTORY_MAX_MESSAGES:])
 
 
-def create_new_conversation(db: Session, user_id: str):
+def create_new_conversation(db: Session, user_id: UUID):
     """
     Creates a new conversation for the given user.
     """
@@ -210,49 +446,161 @@ def generate_conversation_title(first_user_message: str, first_ai_response: str)
     """
     Generates a conversation title using the LLM
     """
-    title_prompt_template = PromptTemplate(
-        template="Generate a short 3-4 word title with an emoji at the start of the title for a conversation based on the following messages. Print ONLY the title.\n"
-                 "User: {user_message}\n"
-                 "AI: {ai_response}\n"
-                 "Title:",
-        input_variables=["user_message", "ai_response"]
+    title = title_client.invoke(
+        TITLE_PROMPT_TEMPLATE.format(user_message=first_user_message, ai_response=first_ai_response)
     )
-    chain = title_prompt_template | ollama_client
-    title = chain.invoke({"user_message": first_user_message, "ai_response": first_ai_response})
     # Ensure title is short
     title = ' '.join(title.strip().split()[:4])
     return title
 
 
-def invoke_chain(system_prompt: str, message_history: List[HumanMessage], message_content: str):
+def build_turn_messages(turn: PreparedTurn, message_content: str) -> List[HumanMessage]:
     """
-    Invokes the LLM chain to generate an AI response.
+    Orders a turn's messages as the history, then the retrieved context, then the new message.
+    Context only ever belongs to the current turn, so it goes after the history rather than into the system prompt.
     """
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessage(content=system_prompt),
-            MessagesPlaceholder(variable_name="messages"),
-        ]
-    )
-    chain = prompt | ollama_client
-    messages = message_history + [HumanMessage(content=message_content)]
+    messages = list(turn.message_history)
+    if turn.context_prompt:
+        messages.append(SystemMessage(content=turn.context_prompt))
+    messages.append(HumanMessage(content=message_content))
+    return messages
+
+
+async def invoke_chain(messages: List[HumanMessage]):
+    """
+    Invokes the LLM chain to generate an AI response, without holding a threadpool thread while Ollama generates.
+    """
+    usage = OllamaUsageHandler()
     try:
         start_time = time.time()
-        ai_msg = chain.invoke({"messages": messages})
+        ai_msg = await CHAT_CHAIN.ainvoke({"messages": messages},
+                                          config={"callbacks": [usage]})
         end_time = time.time()
         response_text = ai_msg
         response_time = end_time - start_time
-        tokens_generated = len(response_text.split())  # Approximate token count
+        tokens_generated = usage.eval_count or 0
         return response_text, response_time, tokens_generated
     except Exception as e:
         logger.error(f"Failed to generate AI response: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate AI response.")
 
 
-def continue_conversation(db: Session, conversation_id: str, user_id: str, message_content: str,
-                          selected_documents: Optional[List[str]] = None):
+def lookup_cached_response(has_documents: bool, message_history: List[HumanMessage], user_id: UUID,
+                           message_content: str):
     """
-    Continues an active conversation, processes user input, and returns the AI's response.
+    Looks up a cached response for a standalone question.
+    Returns the cached response, if any, and the message embedding to cache the new response under on a miss.
+    Turns with history or selected documents depend on more than the message, so they are never cached.
+    """
+    if message_history or has_documents:
+        return None, None
+    try:
+        cached_response, message_embedding = semantic_cache.lookup_response(user_id, message_content)
+    except Exception as e:
+        logger.error(f"Failed to look up semantic cache: {e}")
+        return None, None
+    if cached_response is not None:
+        return cached_response, None
+    return None, message_embedding
+
+
+def sse_event(data: str, event: Optional[str] = None) -> str:
+    """
+    Formats a server-sent event, prefixing every line of the payload with "data:".
+    """
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_chain(background_tasks: BackgroundTasks, conversation_id: UUID, user_id: UUID, turn: PreparedTurn,
+                       message_content: str, user_timestamp: datetime.datetime):
+    """
+    Streams the AI response as server-sent events.
+    Logging the turn and generating the title run as background tasks once the stream has ended.
+    """
+    if turn.cached_response is not None:
+        append_to_history_cache(conversation_id, message_content, turn.cached_response)
+        background_tasks.add_task(
+            save_conversation_turn, conversation_id, user_id, message_content, turn.cached_response, 0, 0,
+            turn.needs_title, user_timestamp, datetime.datetime.now(datetime.timezone.utc)
+        )
+        yield sse_event(turn.cached_response)
+        yield sse_event("", event="done")
+        return
+
+    messages = build_turn_messages(turn, message_content)
+    chunks = []
+    usage = OllamaUsageHandler()
+    start_time = time.time()
+    try:
+        async for chunk in CHAT_CHAIN.astream({"messages": messages},
+                                              config={"callbacks": [usage]}):
+            chunks.append(chunk)
+            yield sse_event(chunk)
+    except Exception as e:
+        logger.error(f"Failed to generate AI response: {e}")
+        yield sse_event("Failed to generate AI response.", event="error")
+        return
+    response_time = time.time() - start_time
+    response_text = "".join(chunks)
+    # Ollama reports the token count with its final chunk; the chunk count is close when it is missing
+    tokens_generated = usage.eval_count or len(chunks)
+
+    append_to_history_cache(conversation_id, message_content, response_text)
+    background_tasks.add_task(
+        save_conversation_turn, conversation_id, user_id, message_content, response_text, tokens_generated,
+        response_time, turn.needs_title, user_timestamp, datetime.datetime.now(datetime.timezone.utc),
+        turn.cache_embedding
+    )
+    yield sse_event("", event="done")
+
+
+def save_conversation_turn(conversation_id: UUID, user_id: UUID, message_content: str, response_text: str,
+                           tokens_generated: int, response_time: float, needs_title: bool,
+                           user_timestamp: datetime.datetime, ai_timestamp: datetime.datetime,
+                           cache_embedding: Optional[np.ndarray] = None):
+    """
+    Logs a turn, titles the conversation and caches the response after the response has been sent.
+    Uses its own session since the request's is already closed by then.
+    """
+    if cache_embedding is not None:
+        try:
+            semantic_cache.store_response(user_id, cache_embedding, response_text)
+        except Exception as e:
+            logger.error(f"Failed to cache response: {e}")
+
+    try:
+        # The turn is committed first, so it is visible to every reader and never waits on the title
+        with session_scope() as db:
+            log_message_to_db(db, conversation_id, user_id, message_content, response_text, tokens_generated,
+                              response_time, user_timestamp, ai_timestamp)
+    except Exception as e:
+        logger.error(f"Failed to log conversation: {e}")
+        return
+
+    if not needs_title:
+        return
+    try:
+        # The title gets its own short transaction once generated, so none stays open across the LLM call
+        title = generate_conversation_title(message_content, response_text)
+        if title:
+            with session_scope() as db:
+                # Conditional UPDATE: no row is loaded, and nothing is written if another turn titled it first
+                db.execute(update(Conversation).where(
+                    Conversation.id == conversation_id,
+                    Conversation.title.is_(None)
+                ).values(title=title))
+    except Exception as e:
+        logger.error(f"Failed to generate conversation title: {e}")
+
+
+def prepare_conversation_turn(db: Session, conversation_id: UUID, user_id: UUID, message_content: str,
+                              selected_documents: Optional[List[str]] = None):
+    """
+    Validates the conversation and selected documents, and builds the system prompt and message history for a turn.
+    Also looks the message up in the semantic cache. Runs on a worker thread, since it uses the request's session,
+    and closes that session once done.
     """
     conversation = db.query(Conversation).filter(
         Conversation.id == conversation_id,
@@ -263,138 +611,154 @@ def continue_conversation(db: Session, conversation_id: str, user_id: str, messa
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found or closed")
 
+    needs_title = not conversation.title
+
+    # Start embedding the message for retrieval now, so the Ollama round trip overlaps the database work below
+    query_embedding = None
+    if selected_documents or conversation.document_links:
+        query_embedding = _QUERY_EMBEDDING_POOL.submit(embeddings.embed_query, message_content)
+
     if selected_documents:
         try:
             selected_document_uuids = [UUID(doc_id) for doc_id in selected_documents]
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid document ID format")
 
-        user_documents = db.query(Document.id).filter(
+        valid_document_count = db.query(func.count(Document.id)).filter(
             Document.user_id == user_id,
             Document.id.in_(selected_document_uuids)
-        ).all()
-
-        user_document_ids = [str(doc.id) for doc in user_documents]
+        ).scalar()
 
-        invalid_document_ids = set(selected_documents) - set(user_document_ids)
-        if invalid_document_ids:
+        if valid_document_count != len(set(selected_document_uuids)):
             raise HTTPException(status_code=404, detail="One or more documents does not exist")
 
-        # Add new document IDs to the existing list without rewriting it
+        # Link only the documents that are not already selected in the conversation
+        linked_document_ids = set(conversation.selected_document_ids)
         for doc_id in selected_document_uuids:
-            if doc_id not in conversation.selected_document_ids:
-                conversation.selected_document_ids.append(doc_id)
-
-        # Mark the attribute as modified
-        flag_modified(conversation, "selected_document_ids")
+            if doc_id not in linked_document_ids:
+                conversation.document_links.append(ConversationDocument(document_id=doc_id))
+                linked_document_ids.add(doc_id)
 
         db.commit()
     else:
-        selected_document_uuids = [str(doc_id) for doc_id in conversation.selected_document_ids]
+        selected_document_uuids = conversation.selected_document_ids
 
-    embeddings = OllamaEmbeddings(
-        base_url=OLLAMA_URL,
-        model=EMBEDDING_MODEL_NAME
-    )
-    vectorstore = Chroma(
-        collection_name=user_id,
-        embedding_function=embeddings,
-        persist_directory=CHROMADB_PERSIST_DIRECTORY,
-    )
+    selected_document_ids = [str(doc_id) for doc_id in selected_document_uuids]
+    message_history = get_conversation_messages(db, conversation_id, user_id)
+    context_content = None
 
-    try:
-        if vectorstore._collection.count() == 0:
-            retriever = None
-        else:
-            if selected_document_uuids:
-                retriever = vectorstore.as_retriever(
-                    search_kwargs={"k": 3},
-                    where={"document_id": {"$in": selected_document_uuids}}
+    if selected_document_ids:
+        try:
+            if collection_has_vectors(user_id):
+                # Query the collection directly so only the chunk texts come back
+                results = get_collection(user_id).query(
+                    query_embeddings=[query_embedding.result()],
+                    n_results=RETRIEVAL_K,
+                    where={"document_id": {"$in": selected_document_ids}},
+                    include=["documents"]
                 )
-            else:
-                retriever = None  # No documents selected
-    except Exception as e:
-        logger.error(f"Error accessing vector store: {e}")
-        retriever = None
+                context_content = "\n\n".join(results["documents"][0])
+        except Exception as e:
+            logger.error(f"Error accessing vector store: {e}")
 
-    message_history = get_conversation_messages(db, conversation_id, user_id)
+    context_prompt = CONTEXT_PROMPT + context_content if context_content else None
 
-    if retriever:
-        context_docs = retriever.get_relevant_documents(message_content)
-        context_content = "\n\n".join([doc.page_content for doc in context_docs])
-        system_prompt = f"""
-        You are Home AI assistant. Your job is to assist house members for question-answering tasks. Your native language is English, but you can speak other languages too.
-        Use the following pieces of retrieved context to answer the question. If you don't know the answer, say that you don't know.
-    
-        Documents:
-        {context_content}
-        """
-    else:
-        system_prompt = """
-        You are Home AI assistant. Your job is to assist house members for question-answering tasks. Your native language is English, but you can speak other languages too.
-        """
+    cached_response, cache_embedding = lookup_cached_response(bool(selected_document_ids), message_history, user_id,
+                                                              message_content)
+    # Long messages can push the prompt past the model's context, where Ollama would cut the system prompt first
+    message_history = trim_history(message_history, settings.history_max_tokens)
+    # End the session's transaction, so its connection returns to the pool instead of idling through the model call
+    db.close()
+    return PreparedTurn(context_prompt, message_history, needs_title, cached_response, cache_embedding)
 
-    response_text, response_time, tokens_generated = invoke_chain(system_prompt, message_history, message_content)
 
-    try:
-        llm_message = log_message_to_db(db, conversation_id, user_id, message_content, response_text, tokens_generated,
-                                        response_time)
-    except Exception as e:
-        logger.error(f"Failed to log conversation: {e}")
-        raise HTTPException(status_code=500, detail="Failed to log conversation.")
+async def continue_conversation(db: Session, background_tasks: BackgroundTasks, conversation_id: UUID, user_id: UUID,
+                                message_content: str, selected_documents: Optional[List[str]] = None):
+    """
+    Continues an active conversation, processes user input, and returns the AI's response.
+    Logging the turn and generating the title run as background tasks once the response is sent.
+    """
+    user_timestamp = datetime.datetime.now(datetime.timezone.utc)
+    turn = await run_in_threadpool(
+        prepare_conversation_turn, db, conversation_id, user_id, message_content, selected_documents
+    )
 
-    if not conversation.title:
-        conversation.title = generate_conversation_title(message_content, response_text)
-        db.commit()
+    if turn.cached_response is not None:
+        response_text, response_time, tokens_generated = turn.cached_response, 0, 0
+    else:
+        response_text, response_time, tokens_generated = await invoke_chain(
+            build_turn_messages(turn, message_content)
+        )
+    ai_timestamp = datetime.datetime.now(datetime.timezone.utc)
+    # Updated before the response goes out, so the next turn sees this one even if logging is still pending
+    append_to_history_cache(conversation_id, message_content, response_text)
 
-    return llm_message
+    background_tasks.add_task(
+        save_conversation_turn, conversation_id, user_id, message_content, response_text, tokens_generated,
+        response_time, turn.needs_title, user_timestamp, ai_timestamp, turn.cache_embedding
+    )
+
+    return {
+        "sender_id": ASSISTANT_UUID,
+        "content": response_text,
+        "timestamp": ai_timestamp,
+        "tokens_generated": tokens_generated,
+        "response_time": response_time
+    }
 
 
-def log_message_to_db(db: Session, conversation_id: str, user_id: str, user_message: str, ai_response: str,
-                      tokens_generated: int, response_time: float):
+def log_message_to_db(db: Session, conversation_id: UUID, user_id: UUID, user_message: str, ai_response: str,
+                      tokens_generated: int, response_time: float, user_timestamp: datetime.datetime = None,
+                      ai_timestamp: datetime.datetime = None):
     """
-    Logs user and AI messages to the database.
+    Logs user and AI messages to the database. The caller commits.
+    Explicit timestamps keep the turn ordered by when it happened rather than when it was written.
     """
-    new_message = Message(
-        conversation_id=conversation_id,
-        sender_id=user_id,
-        content=user_message,
-        llm_model=MODEL_NAME,
-        tokens_generated=0,
-        response_time=0,
-    )
-    db.add(new_message)
-
-    llm_message = Message(
-        conversation_id=conversation_id,
-        sender_id=ASSISTANT_UUID,
-        content=ai_response,
-        llm_model=MODEL_NAME,
-        tokens_generated=tokens_generated,
-        response_time=response_time
-    )
-    db.add(llm_message)
-    db.commit()
-    return llm_message
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # A Core insert writes both rows in one statement without going through the unit of work
+    db.execute(insert(Message), [
+        {
+            "conversation_id": conversation_id,
+            "sender_id": user_id,
+            "content": user_message,
+            "llm_model": settings.model_name,
+            "tokens_generated": 0,
+            "response_time": 0,
+            "timestamp": user_timestamp or now
+        },
+        {
+            "conversation_id": conversation_id,
+            "sender_id": ASSISTANT_UUID,
+            "content": ai_response,
+            "llm_model": settings.model_name,
+            "tokens_generated": tokens_generated,
+            "response_time": response_time,
+            "timestamp": ai_timestamp or now
+        }
+    ])
 
 
-def delete_conversation(db: Session, conversation_id: str, user_id: str):
+def delete_conversation(db: Session, conversation_id: UUID, user_id: UUID):
     """
     Deletes a conversation from the database.
     """
-    conversation = db.query(Conversation).filter(
+    conversation_exists = db.query(exists().where(
         Conversation.id == conversation_id,
         Conversation.user_id == user_id
-    ).first()
+    )).scalar()
 
-    if not conversation:
+    if not conversation_exists:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    db.query(Message).filter(Message.conversation_id == conversation_id).delete()
-
-    conversation.selected_document_ids = []
-    db.commit()
-
-    db.delete(conversation)
-    db.commit()
+    try:
+        # Databases created before messages cascaded on delete still need the explicit bulk delete.
+        # Document links cascade in the database, so the conversation row is never loaded.
+        db.query(Message).filter(Message.conversation_id == conversation_id).delete(synchronize_session=False)
+        db.query(Conversation).filter(Conversation.id == conversation_id).delete(synchronize_session=False)
+        db.commit()
+        history_cache.pop(conversation_id)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to delete conversation {conversation_id}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to delete conversation.")
     return {"message": "Conversation and related messages deleted successfully"}
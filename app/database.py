@@ -1,43 +1,69 @@
-import os
+from contextlib import contextmanager
 
 import psycopg2
-from dotenv import load_dotenv
+from psycopg2 import sql
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-load_dotenv()
+from .config import get_settings
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-DATABASE_USERNAME = os.getenv("DATABASE_USERNAME")
-DATABASE_PASSWORD = os.getenv("DATABASE_PASSWORD")
-DATABASE_NAME = os.getenv("DATABASE_NAME")
+settings = get_settings()
 
 
 def create_db_if_not_exists():
     conn = psycopg2.connect(
         dbname='postgres',
-        user=DATABASE_USERNAME,
-        password=DATABASE_PASSWORD,
-        host=DATABASE_URL.replace('http://', '').replace('https://', '')
+        user=settings.database_username,
+        password=settings.database_password,
+        host=settings.database_url.replace('http://', '').replace('https://', '')
     )
     conn.autocommit = True
     cur = conn.cursor()
-    cur.execute(f"SELECT 1 FROM pg_database WHERE datname = '{DATABASE_NAME}';")
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (settings.database_name,))
     if not cur.fetchone():
-        cur.execute(f"CREATE DATABASE {DATABASE_NAME} WITH ENCODING 'UTF8' TEMPLATE template0;")
+        cur.execute(sql.SQL("CREATE DATABASE {} WITH ENCODING 'UTF8' TEMPLATE template0;").format(
+            sql.Identifier(settings.database_name)
+        ))
     conn.close()
 
 
-create_db_if_not_exists()
-
 # SQLAlchemy DB Connection with UTF-8 encoding
-SQLALCHEMY_DATABASE_URL = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_URL}/{DATABASE_NAME}?client_encoding=utf8"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.database_username}:{settings.database_password}@{settings.database_url}/{settings.database_name}?client_encoding=utf8"
+# INSERT executemany is already sent as multi-row VALUES (insertmanyvalues); values_plus_batch also pages
+# UPDATE and DELETE executemany through psycopg2's execute_batch instead of one round trip per row
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    # Sync endpoints each hold a session on one of the worker threads, and background tasks open their own,
+    # so the pool has to cover more than the default 5 + 10 connections
+    pool_size=settings.database_pool_size,
+    max_overflow=settings.database_max_overflow,
+    pool_timeout=settings.database_pool_timeout,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    executemany_mode="values_plus_batch",
+    insertmanyvalues_page_size=1000
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+@contextmanager
+def session_scope():
+    """
+    Provides a session for work outside a request: committed on success, rolled back on error, and always closed.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
 def get_db():
     db = SessionLocal()
     try:
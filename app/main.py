@@ -1,31 +1,68 @@
+import asyncio
 from contextlib import asynccontextmanager
-from datetime import timedelta
+from datetime import datetime, timezone
 from typing import List
+from uuid import UUID
 
-from fastapi import Depends, HTTPException, status, File, UploadFile
+from anyio import to_thread
+from fastapi import BackgroundTasks, Depends, HTTPException, status, File, UploadFile
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import exists
 from sqlalchemy.orm import Session
 
-from . import models, schemas, auth, conversations
-from .database import engine
-from .database import get_db
+from . import models, schemas, auth, conversations, rag_processing, semantic_cache
+from .config import get_settings
+from .database import get_db, session_scope
 from .models import User, UserRole
 from .schemas import ContinueConversationRequest
-from .utils import ensure_assistant_user_exists, get_or_create_secret_key
+from .utils import ensure_assistant_user_exists
 
-models.Base.metadata.create_all(bind=engine)
+settings = get_settings()
+
+
+def run_with_session(func, *args):
+    """
+    Runs func in a session scope of its own, so the connection is returned even if it fails.
+    """
+    with session_scope() as db:
+        return func(db, *args)
+
+
+async def save_semantic_caches_periodically():
+    """
+    Writes changed semantic caches to disk every few minutes, so a crash does not lose everything since startup.
+    """
+    while True:
+        await asyncio.sleep(settings.semantic_cache_save_interval_seconds)
+        await run_in_threadpool(semantic_cache.save_all)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    db = next(get_db())
-    ensure_assistant_user_exists(db, User, UserRole)
-    get_or_create_secret_key(db)
+    # Sync endpoints hold a thread for as long as their database work takes; the default of 40 threads queues
+    # requests while the connection pool still has connections to spare
+    to_thread.current_default_thread_limiter().total_tokens = settings.worker_threads
+
+    # The database and its schema are created by the migrations (alembic upgrade head) before the server starts
+    # Both touch independent rows, so they run side by side on worker threads instead of blocking the event loop
+    await asyncio.gather(
+        run_in_threadpool(run_with_session, ensure_assistant_user_exists, User, UserRole),
+        run_in_threadpool(run_with_session, auth.load_secret_key)
+    )
+    # Warm up in the background so startup does not wait for Ollama to load the models or Chroma its indexes
+    warm_up = asyncio.create_task(run_in_threadpool(conversations.warm_up_models))
+    warm_up_chroma = asyncio.create_task(run_in_threadpool(rag_processing.warm_up_collections))
+    save_semantic_caches = asyncio.create_task(save_semantic_caches_periodically())
 
     yield
 
-    db.close()
+    warm_up.cancel()
+    warm_up_chroma.cancel()
+    save_semantic_caches.cancel()
+    await run_in_threadpool(semantic_cache.save_all)
 
 
 description = "This is the API for the Home AI project. It allows users to interact with the AI assistant, upload documents, and manage their profile."
@@ -57,7 +94,9 @@ app = FastAPI(
     description=description,
     version="1.0.0",
     lifespan=lifespan,
-    openapi_tags=tags_metadata
+    openapi_tags=tags_metadata,
+    # orjson serializes the conversation, message and document lists several times faster than the json module
+    default_response_class=ORJSONResponse
 )
 
 
@@ -67,59 +106,30 @@ def read_root():
 
 
 @app.post("/token", response_model=schemas.Token, tags=["Auth"])
-def login_for_access_token(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await auth.authenticate_user_async(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = auth.create_access_token(
-        data={"user_id": str(user.user_id)},
-        expires_delta=access_token_expires,
-        db=db  # Pass the db session here
-    )
+    access_token = auth.create_access_token(data={"user_id": str(user.user_id)})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.post("/users/", response_model=schemas.UserOut, tags=["Users"])
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if db_user:
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    if await run_in_threadpool(auth.email_registered, db, user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    hashed_password = auth.get_password_hash(user.password)
-    new_user = models.User(
-        first_name=user.first_name,
-        last_name=user.last_name,
-        email=user.email,
-        hashed_password=hashed_password
-    )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return schemas.UserOut(
-        user_id=str(new_user.user_id),
-        first_name=new_user.first_name,
-        last_name=new_user.last_name,
-        email=new_user.email,
-        enabled=new_user.enabled,
-        role=new_user.role
-    )
+    hashed_password = await auth.get_password_hash_async(user.password)
+    return await run_in_threadpool(auth.create_user, db, user, hashed_password)
 
 
 @app.get("/users/me/details", response_model=schemas.UserOut, tags=["Users"])
 def get_user_details(current_user: models.User = Depends(auth.get_current_user)):
-    return schemas.UserOut(
-        user_id=str(current_user.user_id),
-        first_name=current_user.first_name,
-        last_name=current_user.last_name,
-        email=current_user.email,
-        enabled=current_user.enabled,
-        role=current_user.role
-    )
+    return current_user
 
 
 @app.put("/users/me/profile", response_model=schemas.UserOut, tags=["Users"])
@@ -129,44 +139,43 @@ def update_my_profile(user: schemas.UserUpdateProfile, db: Session = Depends(get
 
 
 @app.put("/users/me/password", tags=["Auth"])
-def change_my_password(password_data: schemas.ChangePassword, db: Session = Depends(get_db),
-                       current_user: models.User = Depends(auth.get_current_user)):
-    return auth.change_user_password(db, current_user, password_data.old_password, password_data.new_password)
+async def change_my_password(password_data: schemas.ChangePassword, db: Session = Depends(get_db),
+                             current_user: models.User = Depends(auth.get_current_user)):
+    return await auth.change_user_password(db, current_user, password_data.old_password, password_data.new_password)
 
 
 @app.put("/users/{user_id}/profile", response_model=schemas.UserOut, tags=["Users"])
-def update_profile(user_id: str, user: schemas.UserUpdateProfile, db: Session = Depends(get_db),
+def update_profile(user_id: UUID, user: schemas.UserUpdateProfile, db: Session = Depends(get_db),
                    current_user: models.User = Depends(auth.get_current_admin_user)):
     db_user = db.query(models.User).filter(models.User.user_id == user_id).first()
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
 
     if db_user.email != user.email:
-        email_exists = db.query(models.User).filter(models.User.email == user.email).first()
-        if email_exists:
+        if auth.email_registered(db, user.email):
             raise HTTPException(status_code=400, detail="Email already registered")
 
     return auth.update_user_profile(db, db_user, user)
 
 
 @app.put("/users/{user_id}/password", tags=["Auth"])
-def change_user_password(user_id: str, password_data: schemas.ChangePassword, db: Session = Depends(get_db),
-                         current_user: models.User = Depends(auth.get_current_admin_user)):
-    db_user = db.query(models.User).filter(models.User.user_id == user_id).first()
+async def change_user_password(user_id: UUID, password_data: schemas.ChangePassword, db: Session = Depends(get_db),
+                               current_user: models.User = Depends(auth.get_current_admin_user)):
+    db_user = await run_in_threadpool(auth.get_user_by_id, db, user_id)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return auth.change_user_password(db, db_user, password_data.old_password, password_data.new_password)
+    return await auth.change_user_password(db, db_user, password_data.old_password, password_data.new_password)
 
 
 @app.post("/conversations/", response_model=schemas.ConversationOut, tags=["Conversations"])
 def start_conversation(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
-    new_convo = conversations.create_new_conversation(db, user_id=str(current_user.user_id))
+    new_convo = conversations.create_new_conversation(db, user_id=current_user.user_id)
     return new_convo
 
 
 @app.get("/conversations/{conversation_id}/details", response_model=schemas.ConversationOut, tags=["Conversations"])
-def get_conversation_details(conversation_id: str, db: Session = Depends(get_db)):
+def get_conversation_details(conversation_id: UUID, db: Session = Depends(get_db)):
     conversation = db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
@@ -186,64 +195,106 @@ def get_user_conversations(
 
 
 @app.delete("/conversations/{conversation_id}", tags=["Conversations"])
-def delete_conversation(conversation_id: str, db: Session = Depends(get_db),
+def delete_conversation(conversation_id: UUID, db: Session = Depends(get_db),
                         current_user: models.User = Depends(auth.get_current_user)):
-    return conversations.delete_conversation(db, conversation_id, user_id=str(current_user.user_id))
+    return conversations.delete_conversation(db, conversation_id, user_id=current_user.user_id)
 
 
 @app.get("/conversations/{conversation_id}/messages", response_model=List[schemas.MessageOut], tags=["Conversations"])
 def get_conversation_messages(
-        conversation_id: str,
+        conversation_id: UUID,
         db: Session = Depends(get_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    conversation = db.query(models.Conversation).filter(
+    # The ownership check is part of the message query, so a non-empty conversation costs a single round trip
+    messages = db.query(
+        models.Message.sender_id,
+        models.Message.content,
+        models.Message.timestamp,
+        models.Message.tokens_generated,
+        models.Message.response_time
+    ).join(models.Conversation, models.Message.conversation_id == models.Conversation.id).filter(
         models.Conversation.id == conversation_id,
         models.Conversation.user_id == current_user.user_id
-    ).first()
+    ).order_by(models.Message.timestamp.asc()).all()
 
-    if not conversation:
+    if not messages and not db.query(exists().where(
+            models.Conversation.id == conversation_id,
+            models.Conversation.user_id == current_user.user_id
+    )).scalar():
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    messages = db.query(models.Message).filter(
-        models.Message.conversation_id == conversation_id
-    ).order_by(models.Message.timestamp.asc()).all()
-
     return messages
 
 
 @app.post("/conversations/{conversation_id}/continue", response_model=schemas.MessageOut, tags=["Conversations"])
-def continue_existing_conversation(
-        conversation_id: str,
+async def continue_existing_conversation(
+        conversation_id: UUID,
         request: ContinueConversationRequest,
+        background_tasks: BackgroundTasks,
         db: Session = Depends(get_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    llm_message = conversations.continue_conversation(
+    llm_message = await conversations.continue_conversation(
         db,
+        background_tasks,
         conversation_id,
-        user_id=str(current_user.user_id),
+        user_id=current_user.user_id,
         message_content=request.message,
         selected_documents=request.selected_documents
     )
     return llm_message
 
 
+@app.post("/conversations/{conversation_id}/continue/stream", tags=["Conversations"])
+async def stream_existing_conversation(
+        conversation_id: UUID,
+        request: ContinueConversationRequest,
+        background_tasks: BackgroundTasks,
+        db: Session = Depends(get_db),
+        current_user: models.User = Depends(auth.get_current_user)
+):
+    user_id = current_user.user_id
+    user_timestamp = datetime.now(timezone.utc)
+    turn = await run_in_threadpool(
+        conversations.prepare_conversation_turn,
+        db,
+        conversation_id,
+        user_id=user_id,
+        message_content=request.message,
+        selected_documents=request.selected_documents
+    )
+    # FastAPI attaches background_tasks to the response, so tasks added while streaming run after the last event
+    return StreamingResponse(
+        conversations.stream_chain(
+            background_tasks,
+            conversation_id,
+            user_id,
+            turn,
+            request.message,
+            user_timestamp
+        ),
+        media_type="text/event-stream"
+    )
+
+
 @app.post("/documents/upload", tags=["Documents"])
-def upload_documents(
+async def upload_documents(
+        background_tasks: BackgroundTasks,
         files: List[UploadFile] = File(...),
         db: Session = Depends(get_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    return conversations.upload_user_documents(
+    return await conversations.upload_user_documents(
         db=db,
-        user_id=str(current_user.user_id),
+        background_tasks=background_tasks,
+        user_id=current_user.user_id,
         files=files
     )
 
 
 @app.get("/documents/{document_id}/details", response_model=schemas.DocumentOut, tags=["Documents"])
-def get_document_details(document_id: str, db: Session = Depends(get_db)):
+def get_document_details(document_id: UUID, db: Session = Depends(get_db)):
     document = db.query(models.Document).filter(models.Document.id == document_id).first()
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -255,14 +306,14 @@ def get_user_documents(
         db: Session = Depends(get_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    documents = conversations.list_user_documents(db, user_id=str(current_user.user_id))
+    documents = conversations.list_user_documents(db, user_id=current_user.user_id)
     return documents
 
 
 @app.delete("/documents/{document_id}", tags=["Documents"])
 def delete_user_document(
-        document_id: str,
+        document_id: UUID,
         db: Session = Depends(get_db),
         current_user: models.User = Depends(auth.get_current_user)
 ):
-    return conversations.delete_document(db, document_id, user_id=str(current_user.user_id))
+    return conversations.delete_document(db, document_id, user_id=current_user.user_id)
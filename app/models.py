@@ -2,8 +2,8 @@ import enum
 import uuid
 from datetime import datetime, timezone
 
-from sqlalchemy import Column, Integer, String, Boolean, Enum, ForeignKey, DateTime, Text, Float, BigInteger
-from sqlalchemy.dialects.postgresql import UUID, ARRAY
+from sqlalchemy import Column, Integer, String, Boolean, Enum, ForeignKey, DateTime, Text, Float, BigInteger, Index
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -39,6 +39,9 @@ class User(Base):
 
 class Conversation(Base):
     __tablename__ = "conversations"
+    __table_args__ = (
+        Index("ix_conv_user_status", "user_id", "status"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey('users.user_id'), nullable=False)
@@ -46,17 +49,33 @@ class Conversation(Base):
     end_time = Column(DateTime, nullable=True)
     title = Column(String, nullable=True)
     status = Column(String, default="active")
-    selected_document_ids = Column(ARRAY(UUID(as_uuid=True)), default=[])
 
     user = relationship("User", back_populates="conversations")
-    messages = relationship("Message", back_populates="conversation")
+    messages = relationship("Message", back_populates="conversation", passive_deletes=True)
+    document_links = relationship("ConversationDocument", cascade="all, delete-orphan", passive_deletes=True,
+                                  lazy="selectin")
+
+    @property
+    def selected_document_ids(self):
+        return [link.document_id for link in self.document_links]
+
+
+class ConversationDocument(Base):
+    __tablename__ = "conversation_documents"
+
+    conversation_id = Column(UUID(as_uuid=True), ForeignKey('conversations.id', ondelete="CASCADE"), primary_key=True)
+    document_id = Column(UUID(as_uuid=True), ForeignKey('documents.id', ondelete="CASCADE"), primary_key=True,
+                         index=True)
 
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_conv_ts", "conversation_id", "timestamp"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    conversation_id = Column(UUID(as_uuid=True), ForeignKey('conversations.id'), nullable=False)
+    conversation_id = Column(UUID(as_uuid=True), ForeignKey('conversations.id', ondelete="CASCADE"), nullable=False)
     sender_id = Column(UUID(as_uuid=True), ForeignKey('users.user_id'))
     content = Column(Text, nullable=False)
     llm_model = Column(String, nullable=False)
@@ -69,6 +88,9 @@ class Message(Base):
 
 class Document(Base):
     __tablename__ = "documents"
+    __table_args__ = (
+        Index("ix_doc_user_checksum", "user_id", "checksum", unique=True),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey('users.user_id'))
@@ -77,5 +99,7 @@ class Document(Base):
     upload_time = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     size = Column(BigInteger, nullable=False)
     checksum = Column(String, nullable=False)
+    # Chunks stored in Chroma once indexing completes; None while the document is not fully indexed
+    chunk_count = Column(Integer, nullable=True)
 
     user = relationship("User", back_populates="documents")
@@ -1,70 +1,354 @@
+import itertools
 import logging
+import math
+import multiprocessing
 import os
-from typing import List
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import Dict, List
+from uuid import UUID
 
-from fastapi import HTTPException
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
+import chromadb
+import requests
+from chromadb.api import ClientAPI, Collection
 from langchain_community.document_loaders import (
     TextLoader,
     PyPDFLoader,
     UnstructuredWordDocumentLoader,
     CSVLoader
 )
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document as LCDocument
+from langchain_core.embeddings import Embeddings
+from requests.adapters import HTTPAdapter
+from semantic_text_splitter import TextSplitter
+from urllib3.util.retry import Retry
 
+from .config import get_settings
 from .models import Document
+from .utils import TTLCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-CHROMADB_PERSIST_DIRECTORY = os.getenv("CHROMADB_PERSIST_DIRECTORY", "app/chroma_db")
-EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "nomic-embed-text")
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
-DOCUMENTS_DIRECTORY = os.getenv("DOCUMENTS_DIRECTORY", "app/documents")
+settings = get_settings()
 
 
-def process_and_store_documents(documents: List[Document], user_id: str):
+class OllamaBatchEmbeddings(Embeddings):
     """
-    Process and store documents in the Chroma database for a given user.
+    Embeds texts through Ollama's /api/embed endpoint, which takes a whole batch of inputs per request.
+    Batches are spread round-robin over every configured Ollama instance and sent concurrently.
+    Falls back to the single-text /api/embeddings endpoint on servers that predate it.
+    """
+
+    def __init__(self, base_urls: List[str], model: str, batch_size: int = 64, concurrency: int = 4,
+                 keep_alive: str = None):
+        self.base_urls = [base_url.rstrip("/") for base_url in base_urls]
+        self.model = model
+        self.keep_alive = keep_alive
+        # Embeddings are deterministic per model and text, so recent query vectors can be reused as they are
+        self._query_cache = TTLCache(maxsize=256, ttl=300)
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        # Batch workers and request threads all share this session, so its pool is sized for both. Embedding
+        # requests are idempotent, so a dropped connection or a restarting Ollama is retried instead of failing
+        adapter = HTTPAdapter(
+            pool_connections=len(self.base_urls),
+            pool_maxsize=64,
+            max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504),
+                              allowed_methods=frozenset({"POST"}))
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._next_base_url = itertools.cycle(self.base_urls)
+        # Instances already reported as falling back to /api/embeddings, so each one is only logged once
+        self._fallback_base_urls = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(concurrency, len(self.base_urls)),
+            thread_name_prefix="ollama-embed"
+        )
+
+    def _embed_each(self, base_url: str, texts: List[str]) -> List[List[float]]:
+        if base_url not in self._fallback_base_urls:
+            self._fallback_base_urls.add(base_url)
+            logger.warning("Ollama at %s does not serve /api/embed for %s; embedding one text per request",
+                           base_url, self.model)
+        return [self._embed_one(base_url, text) for text in texts]
+
+    def _embed_one(self, base_url: str, text: str) -> List[float]:
+        response = self.session.post(
+            f"{base_url}/api/embeddings",
+            json={"model": self.model, "prompt": text, "keep_alive": self.keep_alive}
+        )
+        response.raise_for_status()
+        # /api/embed returns unit-length vectors and this endpoint does not, so they are normalised the same way;
+        # otherwise vectors from both endpoints in one collection would rank by length instead of direction
+        vector = response.json()["embedding"]
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else vector
+
+    def _embed_batch(self, base_url: str, texts: List[str]) -> List[List[float]]:
+        response = self.session.post(
+            f"{base_url}/api/embed",
+            json={"model": self.model, "input": texts, "keep_alive": self.keep_alive}
+        )
+        if response.status_code == 404:
+            return self._embed_each(base_url, texts)
+        response.raise_for_status()
+        vectors = response.json().get("embeddings")
+        if not vectors or len(vectors) != len(texts):
+            return self._embed_each(base_url, texts)
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self._embed_batch(next(self._next_base_url), batches[0])
+
+        # map yields results in submission order, so the vectors line up with the input texts
+        base_urls = [next(self._next_base_url) for _ in batches]
+        vectors = []
+        for batch_vectors in self._executor.map(self._embed_batch, base_urls, batches):
+            vectors.extend(batch_vectors)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._query_cache.get(text)
+        if vector is None:
+            # Queries use the same endpoint as documents so both sides get the same normalisation
+            vector = self._embed_batch(next(self._next_base_url), [text])[0]
+            self._query_cache.set(text, vector)
+        return vector
+
+
+# The embedding client holds no per-user state, so one instance serves every collection
+embeddings = OllamaBatchEmbeddings(
+    base_urls=(settings.ollama_embed_urls or settings.ollama_url).split(","),
+    model=settings.embedding_model_name,
+    batch_size=settings.ollama_embed_batch_size,
+    concurrency=settings.ollama_embed_concurrency,
+    keep_alive=settings.ollama_keep_alive
+)
+
+
+@lru_cache(maxsize=1)
+def get_chroma_client() -> ClientAPI:
+    """
+    Returns the Chroma client shared by every collection, opened on first use rather than at import,
+    so the loader processes that import this module never open the database.
+    """
+    return chromadb.PersistentClient(path=settings.chromadb_persist_directory)
+
+
+@lru_cache(maxsize=256)
+def get_collection(user_id: UUID) -> Collection:
+    """
+    Returns the Chroma collection of a user, named after their id, opening it only on first use.
+    Chunks are embedded by the callers, so the collection is opened without an embedding function of its own.
+    """
+    return get_chroma_client().get_or_create_collection(name=str(user_id), embedding_function=None)
+
+
+# The splitter keeps no state between calls, so one instance serves every upload
+text_splitter = TextSplitter(capacity=500, overlap=200)
+
+# Writes ingestion batches to Chroma, so embedding one batch overlaps parsing the next
+_INGEST_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ingest")
+
+LOADER_WORKERS = os.cpu_count() or 1
+# Parses and splits uploaded files outside the GIL. Spawned rather than forked, since forking a process that
+# runs threads can copy locks that are held at that moment
+_LOADER_POOL = ProcessPoolExecutor(max_workers=LOADER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+# Chunks embedded and written to Chroma at a time during ingestion: enough to give every embedding worker
+# two batches, while bounding how much of an upload is held in memory
+INGEST_BATCH_SIZE = settings.ollama_embed_batch_size * settings.ollama_embed_concurrency * 2
+
+HAS_VECTORS_TTL_SECONDS = 60
+# Whether a user's collection holds any vectors, so conversation turns can skip counting it
+has_vectors_cache = TTLCache(maxsize=1024, ttl=HAS_VECTORS_TTL_SECONDS)
+
+
+def collection_has_vectors(user_id: UUID) -> bool:
+    """
+    Returns whether the user's collection holds any vectors, counting it only on a cache miss.
+    """
+    has_vectors = has_vectors_cache.get(user_id)
+    if has_vectors is None:
+        has_vectors = get_collection(user_id).count() > 0
+        has_vectors_cache.set(user_id, has_vectors)
+    return has_vectors
+
+
+def warm_up_collections():
     """
-    embeddings = OllamaEmbeddings(
-        base_url=OLLAMA_URL,
-        model=EMBEDDING_MODEL_NAME
+    Opens every user's collection and runs one nearest-neighbour query on it, so its index is loaded from disk
+    before the first upload or conversation turn instead of during it.
+    """
+    try:
+        names = [collection.name for collection in get_chroma_client().list_collections()]
+        for name in names:
+            try:
+                user_id = UUID(name)
+            except ValueError:
+                # Not a user's collection
+                continue
+            collection = get_collection(user_id)
+            sample = collection.peek(limit=1)
+            has_vectors_cache.set(user_id, bool(sample["ids"]))
+            if sample["ids"]:
+                collection.query(query_embeddings=[sample["embeddings"][0]], n_results=1, include=[])
+    except Exception as e:
+        logger.warning(f"Failed to warm up the Chroma collections: {e}")
+
+
+def get_document_loader(file_path: str, file_name: str) -> BaseLoader:
+    """
+    Returns the loader for a document, picked by its file extension.
+    """
+    file_extension = os.path.splitext(file_name)[1].lower()
+
+    if file_extension == ".txt":
+        return TextLoader(file_path)
+    elif file_extension == ".pdf":
+        return PyPDFLoader(file_path)
+    elif file_extension in [".doc", ".docx"]:
+        return UnstructuredWordDocumentLoader(file_path)
+    elif file_extension == ".csv":
+        return CSVLoader(file_path=file_path)
+    raise ValueError(f"Unsupported file type: {file_extension}")
+
+
+def load_and_split(file_path: str, file_name: str, document_id: str, user_id: str) -> List[LCDocument]:
+    """
+    Loads a file and splits it into tagged chunks. Runs in the loader processes, so it only takes plain values.
+    """
+    docs = []
+    for page in get_document_loader(file_path, file_name).lazy_load():
+        # Tag every chunk so retrieval and deletion can filter by document
+        metadata = {**page.metadata, "user_id": user_id, "document_id": document_id, "file_name": file_name}
+        # Chunk ids are numbered through the whole file, so storing the same document again overwrites its chunks
+        docs.extend(
+            LCDocument(id=f"{document_id}:{index}", page_content=chunk, metadata=dict(metadata))
+            for index, chunk in enumerate(text_splitter.chunks(page.page_content), start=len(docs))
+        )
+    return docs
+
+
+def store_chunks(collection: Collection, docs: List[LCDocument]):
+    """
+    Embeds a batch of chunks and upserts them into a collection in a single write, so a retried batch replaces
+    the chunks it already stored instead of duplicating them.
+    """
+    texts = [doc.page_content for doc in docs]
+    collection.upsert(
+        ids=[doc.id for doc in docs],
+        embeddings=embeddings.embed_documents(texts),
+        documents=texts,
+        metadatas=[doc.metadata for doc in docs]
     )
 
-    vectorstore = Chroma(
-        collection_name=user_id,
-        embedding_function=embeddings,
-        persist_directory=CHROMADB_PERSIST_DIRECTORY,
+
+def process_and_store_documents(documents: List[Document], user_id: UUID) -> Dict[UUID, int]:
+    """
+    Process and store documents in the Chroma database for a given user.
+    Files are parsed and split in parallel on the loader processes, at most one file per process ahead of the
+    writer, and their chunks written in fixed-size batches that span documents. Each batch is embedded and written
+    on the ingest pool while the next one is assembled, with at most one batch in flight.
+    A file that cannot be parsed is skipped, so the rest of the batch is still stored. Returns the number of
+    chunks stored for each document that was, keyed by document id; skipped documents are left out.
+    A failed write to Chroma stops the run and its error is raised once the in-flight batch has finished.
+    """
+    collection = get_collection(user_id)
+    pending_docs = []
+    chunk_counts = {}
+    in_flight = None
+
+    def write_batch(docs):
+        nonlocal in_flight
+        if in_flight is not None:
+            in_flight.result()
+            has_vectors_cache.set(user_id, True)
+        in_flight = _INGEST_POOL.submit(store_chunks, collection, docs)
+
+    remaining_documents = iter(documents)
+    loading = deque()
+
+    def load_next():
+        document = next(remaining_documents, None)
+        if document is not None:
+            loading.append((document, _LOADER_POOL.submit(
+                load_and_split, document.file_path, document.file_name, str(document.id), str(user_id)
+            )))
+
+    for _ in range(LOADER_WORKERS):
+        load_next()
+
+    try:
+        while loading:
+            document, loaded = loading.popleft()
+            load_next()
+            try:
+                chunks = loaded.result()
+            except Exception as e:
+                logger.error("Failed to process document %s: %s", document.file_name, e)
+                continue
+            pending_docs.extend(chunks)
+            chunk_counts[document.id] = len(chunks)
+
+            while len(pending_docs) >= INGEST_BATCH_SIZE:
+                write_batch(pending_docs[:INGEST_BATCH_SIZE])
+                pending_docs = pending_docs[INGEST_BATCH_SIZE:]
+
+        if pending_docs:
+            write_batch(pending_docs)
+        if in_flight is not None:
+            in_flight.result()
+            has_vectors_cache.set(user_id, True)
+    except Exception:
+        # A failed write means Chroma or the embedding service is failing, which every remaining file would hit too.
+        # This runs in a background task, so the error goes to its caller to log rather than to an HTTP response
+        for _, queued in loading:
+            queued.cancel()
+        if in_flight is not None:
+            wait([in_flight])
+        raise
+
+    return chunk_counts
+
+
+def copy_document_vectors(source_user_id: UUID, source_document_id: str, source_chunk_count: int,
+                          document: Document, user_id: UUID) -> bool:
+    """
+    Copies the chunks and embeddings of an identical document from another user's collection, so the same content
+    is never embedded twice. Returns False, copying nothing, unless the source holds all of its recorded chunks.
+    """
+    source = get_collection(source_user_id).get(
+        where={"document_id": source_document_id},
+        include=["embeddings", "documents", "metadatas"]
     )
+    # A source that lost chunks since it was indexed would leave this copy truncated for good
+    if not source["ids"] or len(source["ids"]) != source_chunk_count:
+        return False
+
+    metadatas = []
+    for metadata in source["metadatas"]:
+        metadata = {**metadata, "user_id": str(user_id), "document_id": str(document.id),
+                    "file_name": document.file_name}
+        # Loaders record the path they read, which is the other user's copy of the file
+        if "source" in metadata:
+            metadata["source"] = document.file_path
+        metadatas.append(metadata)
 
-    for document in documents:
-        file_path = document.file_path
-        file_extension = os.path.splitext(document.file_name)[1].lower()
-
-        try:
-            if file_extension == ".txt":
-                loader = TextLoader(file_path)
-            elif file_extension == ".pdf":
-                loader = PyPDFLoader(file_path)
-            elif file_extension in [".doc", ".docx"]:
-                loader = UnstructuredWordDocumentLoader(file_path)
-            elif file_extension == ".csv":
-                loader = CSVLoader(file_path=file_path)
-            else:
-                raise ValueError(f"Unsupported file type: {file_extension}")
-
-            loaded_documents = loader.load()
-
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=200)
-            docs = text_splitter.split_documents(loaded_documents)
-
-            vectorstore.add_documents(docs, metadata={
-                "user_id": user_id,
-                "document_id": str(document.id),
-                "file_name": document.file_name
-            })
-        except Exception as e:
-            logger.error(f"Failed to process document {document.file_name}: {e}")
-            raise HTTPException(status_code=400, detail=f"Failed to process document {document.file_name}: {e}")
+    collection = get_collection(user_id)
+    for start in range(0, len(metadatas), INGEST_BATCH_SIZE):
+        end = start + INGEST_BATCH_SIZE
+        collection.upsert(
+            ids=[f"{document.id}:{index}" for index in range(start, min(end, len(metadatas)))],
+            embeddings=source["embeddings"][start:end],
+            documents=source["documents"][start:end],
+            metadatas=metadatas[start:end]
+        )
+    has_vectors_cache.set(user_id, True)
+    return True
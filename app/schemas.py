@@ -1,9 +1,33 @@
+import re
 from datetime import datetime
 from typing import Optional, List
 from uuid import UUID
 
 from pydantic import BaseModel, EmailStr, Field, field_validator
 
+# Matches any password of at least 8 characters with a digit, an uppercase letter and a special character,
+# so valid passwords are accepted in one compiled match
+_STRONG_PASSWORD = re.compile(r'(?=.*\d)(?=.*[A-Z])(?=.*[!@#$%^&*()\-_=+\[\]{}|;:,.<>?/]).{8,}', re.DOTALL)
+PASSWORD_SPECIAL_CHARACTERS = frozenset("!@#$%^&*()-_=+[]{}|;:,.<>?/")
+
+
+def validate_password_strength(password):
+    """
+    Checks that a password is at least 8 characters long and has a number, an uppercase letter and a special
+    character. The rules are only checked one by one to name the one that failed.
+    """
+    if isinstance(password, str) and _STRONG_PASSWORD.match(password):
+        return password
+    if len(password) < 8:
+        raise ValueError('Password must be at least 8 characters long.')
+    if not any(char.isdigit() for char in password):
+        raise ValueError('Password must contain at least one number.')
+    if not any(char.isupper() for char in password):
+        raise ValueError('Password must contain at least one uppercase letter.')
+    if PASSWORD_SPECIAL_CHARACTERS.isdisjoint(password):
+        raise ValueError('Password must contain at least one special character.')
+    return password
+
 
 class UserBase(BaseModel):
     first_name: str = Field(..., min_length=1, max_length=50, pattern=r'^[a-zA-Z]+$')
@@ -11,45 +35,29 @@ class UserBase(BaseModel):
     email: EmailStr
     enabled: Optional[bool] = True
 
-    @field_validator('first_name', 'last_name', mode='before')
-    def names_must_be_alphabetic(cls, value):
-        if not value.isalpha():
-            raise ValueError('Names must contain only alphabetic characters.')
-        return value
-
 
 class UserCreate(UserBase):
     password: str = Field(..., min_length=8, max_length=50)
 
     @field_validator('password', mode='before')
     def validate_password(cls, password):
-        if len(password) < 8:
-            raise ValueError('Password must be at least 8 characters long.')
-        if not any(char.isdigit() for char in password):
-            raise ValueError('Password must contain at least one number.')
-        if not any(char.isupper() for char in password):
-            raise ValueError('Password must contain at least one uppercase letter.')
-        if not any(char in "!@#$%^&*()-_=+[]{}|;:,.<>?/" for char in password):
-            raise ValueError('Password must contain at least one special character.')
-        return password
+        return validate_password_strength(password)
 
 
 class UserOut(UserBase):
-    user_id: str
+    user_id: UUID
     role: str
 
+    class Config:
+        from_attributes = True
+        frozen = True
+
 
 class UserUpdateProfile(BaseModel):
     first_name: str = Field(..., min_length=1, max_length=50, pattern=r'^[a-zA-Z]+$')
     last_name: str = Field(..., min_length=1, max_length=50, pattern=r'^[a-zA-Z]+$')
     email: EmailStr
 
-    @field_validator('first_name', 'last_name', mode='before')
-    def names_must_be_alphabetic(cls, value):
-        if not value.isalpha():
-            raise ValueError('Names must contain only alphabetic characters.')
-        return value
-
 
 class ChangePassword(BaseModel):
     old_password: str = Field(..., min_length=8, max_length=50)
@@ -57,25 +65,23 @@ class ChangePassword(BaseModel):
 
     @field_validator('new_password', mode='before')
     def validate_password(cls, password):
-        if len(password) < 8:
-            raise ValueError('Password must be at least 8 characters long.')
-        if not any(char.isdigit() for char in password):
-            raise ValueError('Password must contain at least one number.')
-        if not any(char.isupper() for char in password):
-            raise ValueError('Password must contain at least one uppercase letter.')
-        if not any(char in "!@#$%^&*()-_=+[]{}|;:,.<>?/" for char in password):
-            raise ValueError('Password must contain at least one special character.')
-        return password
+        return validate_password_strength(password)
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
 
+    class Config:
+        frozen = True
+
 
 class TokenData(BaseModel):
     user_id: Optional[str] = None
 
+    class Config:
+        frozen = True
+
 
 class ConversationCreate(BaseModel):
     user_id: str
@@ -87,32 +93,21 @@ class ContinueConversationRequest(BaseModel):
 
 
 class ConversationOut(BaseModel):
-    id: str
+    id: UUID
     start_time: datetime
     end_time: Optional[datetime] = None
     title: Optional[str] = None
     status: str
-    user_id: str
-    selected_document_ids: List[str] = []
+    user_id: UUID
+    selected_document_ids: List[UUID] = []
 
     class Config:
         from_attributes = True
-
-    @field_validator('id', 'user_id', mode='before')
-    def convert_uuid_to_str(cls, value):
-        if isinstance(value, UUID):
-            return str(value)
-        return value
-
-    @field_validator('selected_document_ids', mode='before')
-    def convert_uuids_to_str(cls, value):
-        if value and isinstance(value, list):
-            return [str(v) for v in value]
-        return value
+        frozen = True
 
 
 class DocumentOut(BaseModel):
-    id: str
+    id: UUID
     file_name: str
     upload_time: datetime
     size: int
@@ -120,16 +115,11 @@ class DocumentOut(BaseModel):
 
     class Config:
         from_attributes = True
-
-    @field_validator('id', mode='before')
-    def convert_uuid_to_str(cls, value):
-        if isinstance(value, UUID):
-            return str(value)
-        return value
+        frozen = True
 
 
 class MessageOut(BaseModel):
-    sender_id: Optional[str]
+    sender_id: Optional[UUID]
     content: str
     timestamp: datetime
     tokens_generated: int
@@ -137,9 +127,4 @@ class MessageOut(BaseModel):
 
     class Config:
         from_attributes = True
-
-    @field_validator('sender_id', mode='before')
-    def convert_uuid_to_str(cls, value):
-        if isinstance(value, UUID):
-            return str(value)
-        return value
+        frozen = True
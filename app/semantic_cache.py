@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+
+from .config import get_settings
+from .rag_processing import embeddings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# Kept apart from Chroma's data directory, which Chroma owns
+SEMANTIC_CACHE_DIRECTORY = settings.semantic_cache_directory
+
+
+class SemanticCache:
+    """
+    A user's cached responses, held in memory with their message embeddings L2-normalised in one matrix.
+    A lookup is a single matrix-vector product, which scores every entry by cosine similarity at once.
+    """
+
+    def __init__(self, matrix: Optional[np.ndarray] = None, timestamps: Optional[np.ndarray] = None,
+                 responses: Optional[list] = None):
+        self.matrix = matrix
+        self.timestamps = timestamps if timestamps is not None else np.empty(0)
+        self.responses = responses if responses is not None else []
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def lookup(self, query: np.ndarray) -> Optional[str]:
+        with self._lock:
+            if not self.responses:
+                return None
+            scores = self.matrix @ query
+            scores[self.timestamps < time.time() - settings.semantic_cache_ttl_seconds] = -1
+            best = int(scores.argmax())
+            if scores[best] >= settings.semantic_cache_threshold:
+                return self.responses[best]
+        return None
+
+    def add(self, vector: np.ndarray, response: str):
+        now = time.time()
+        with self._lock:
+            if self.responses:
+                # Compact on insert: drop expired entries and, past the size limit, the oldest ones
+                keep = np.flatnonzero(self.timestamps >= now - settings.semantic_cache_ttl_seconds)
+                if len(keep) >= settings.semantic_cache_max_entries:
+                    keep = keep[len(keep) - settings.semantic_cache_max_entries + 1:]
+                self.matrix = np.vstack([self.matrix[keep], vector])
+                self.timestamps = np.append(self.timestamps[keep], now)
+                self.responses = [self.responses[i] for i in keep] + [response]
+            else:
+                self.matrix = vector[np.newaxis, :]
+                self.timestamps = np.array([now])
+                self.responses = [response]
+            self.dirty = True
+
+    def save(self, path: str):
+        # Only the references are taken under the lock: add() replaces the arrays rather than changing them in place
+        with self._lock:
+            if not self.dirty or not self.responses:
+                return
+            matrix, timestamps, responses = self.matrix, self.timestamps, self.responses
+            self.dirty = False
+        try:
+            # Responses are stored as one UTF-8 JSON buffer, since a NumPy string array pads every entry to the longest
+            responses_json = np.frombuffer(json.dumps(responses).encode("utf-8"), dtype=np.uint8)
+            # Written to a temporary file and renamed over the old one, so a crash mid-write never leaves it corrupt
+            temporary_path = f"{path}.tmp"
+            with open(temporary_path, "wb") as f:
+                np.savez(f, matrix=matrix, timestamps=timestamps, responses_json=responses_json)
+            os.replace(temporary_path, path)
+        except Exception:
+            with self._lock:
+                self.dirty = True
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "SemanticCache":
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            if "responses_json" in data:
+                responses = json.loads(data["responses_json"].tobytes().decode("utf-8"))
+            else:
+                # Files saved before the responses were stored as JSON
+                responses = data["responses"].tolist()
+            return cls(data["matrix"], data["timestamps"], responses)
+
+
+_caches: Dict[UUID, SemanticCache] = {}
+_caches_lock = threading.Lock()
+# Serialises the periodic and shutdown saves, which would otherwise write the same temporary files
+_save_lock = threading.Lock()
+
+
+def _cache_path(user_id: UUID) -> str:
+    return os.path.join(SEMANTIC_CACHE_DIRECTORY, f"{user_id}.npz")
+
+
+def get_semantic_cache(user_id: UUID) -> SemanticCache:
+    """
+    Returns the semantic cache of a user, loading it from disk on first use.
+    """
+    with _caches_lock:
+        cache = _caches.get(user_id)
+        if cache is None:
+            cache = _caches[user_id] = SemanticCache.load(_cache_path(user_id))
+        return cache
+
+
+def embed_message(message: str) -> np.ndarray:
+    vector = np.asarray(embeddings.embed_query(message), dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def lookup_response(user_id: UUID, message: str) -> Tuple[Optional[str], np.ndarray]:
+    """
+    Returns the cached response to a similar enough message, if any, along with the message's embedding.
+    """
+    message_embedding = embed_message(message)
+    return get_semantic_cache(user_id).lookup(message_embedding), message_embedding
+
+
+def store_response(user_id: UUID, message_embedding: np.ndarray, response: str):
+    """
+    Caches a response under the normalised embedding of the message that produced it.
+    """
+    get_semantic_cache(user_id).add(message_embedding, response)
+
+
+def save_all():
+    """
+    Writes every semantic cache that changed since it was last saved to disk.
+    """
+    with _caches_lock:
+        caches = list(_caches.items())
+    with _save_lock:
+        try:
+            os.makedirs(SEMANTIC_CACHE_DIRECTORY, exist_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to create the semantic cache directory: {e}")
+            return
+        for user_id, cache in caches:
+            try:
+                cache.save(_cache_path(user_id))
+            except Exception as e:
+                logger.error(f"Failed to save semantic cache for user {user_id}: {e}")
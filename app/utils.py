@@ -1,6 +1,10 @@
 import secrets
+import threading
+import time
 import uuid
+from collections import OrderedDict
 
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 
 from .models import SecretKey
@@ -11,31 +15,79 @@ ASSISTANT_UUID = uuid.UUID("00000000-0000-0000-0000-000000000000")
 def ensure_assistant_user_exists(db, User, UserRole):
     """
     Ensure that the assistant user exists in the database.
+    A single INSERT ... ON CONFLICT DO NOTHING, so workers starting together cannot race to create it.
     """
-    assistant_user = db.query(User).filter(User.user_id == ASSISTANT_UUID).first()
-    if not assistant_user:
-        new_user = User(
-            user_id=ASSISTANT_UUID,
-            first_name="Assistant",
-            last_name="Bot",
-            email="assistant@bot.com",
-            hashed_password="",
-            role=UserRole.house_member,
-            enabled=True
-        )
-        db.add(new_user)
-        db.commit()
+    db.execute(insert(User).values(
+        user_id=ASSISTANT_UUID,
+        first_name="Assistant",
+        last_name="Bot",
+        email="assistant@bot.com",
+        hashed_password="",
+        role=UserRole.house_member,
+        enabled=True
+    ).on_conflict_do_nothing())
+    db.commit()
 
 
 def get_or_create_secret_key(db: Session) -> str:
     """
     Get or create a secret key for encoding and decoding JWT tokens.
+    Concurrent workers insert the same row id, so whichever commits first wins and all of them read its key.
     """
-    secret_key = db.query(SecretKey).first()
-    if not secret_key:
-        new_key = secrets.token_urlsafe(64)
-        secret_key = SecretKey(key=new_key)
-        db.add(secret_key)
+    secret_key = db.query(SecretKey.key).order_by(SecretKey.id).limit(1).scalar()
+    if secret_key is None:
+        db.execute(insert(SecretKey).values(id=1, key=secrets.token_urlsafe(64)).on_conflict_do_nothing())
         db.commit()
-        db.refresh(secret_key)
-    return secret_key.key
+        secret_key = db.query(SecretKey.key).order_by(SecretKey.id).limit(1).scalar()
+    return secret_key
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache whose entries expire after a per-entry TTL.
+    The least recently used entry is evicted once maxsize is reached.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def pop_where(self, predicate):
+        """
+        Removes every entry whose value matches the predicate.
+        """
+        with self._lock:
+            keys = [key for key, (value, _) in self._data.items() if predicate(value)]
+            for key in keys:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
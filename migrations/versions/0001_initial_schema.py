@@ -0,0 +1,110 @@
+"""Initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2024-10-01 00:00:00.000000
+
+The schema as it was created by Base.metadata.create_all() before migrations were introduced.
+Tables that already exist are left as they are, so databases created that way can be upgraded in place.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    existing_tables = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if "secret_keys" not in existing_tables:
+        op.create_table(
+            "secret_keys",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("key", sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint("id")
+        )
+        op.create_index("ix_secret_keys_id", "secret_keys", ["id"])
+
+    if "users" not in existing_tables:
+        op.create_table(
+            "users",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("user_id", postgresql.UUID(as_uuid=True), nullable=True),
+            sa.Column("first_name", sa.String(), nullable=True),
+            sa.Column("last_name", sa.String(), nullable=True),
+            sa.Column("email", sa.String(), nullable=True),
+            sa.Column("hashed_password", sa.String(), nullable=True),
+            sa.Column("role", sa.Enum("admin", "house_member", name="userrole"), nullable=True),
+            sa.Column("enabled", sa.Boolean(), nullable=True),
+            sa.PrimaryKeyConstraint("id")
+        )
+        op.create_index("ix_users_id", "users", ["id"])
+        op.create_index("ix_users_user_id", "users", ["user_id"], unique=True)
+        op.create_index("ix_users_first_name", "users", ["first_name"])
+        op.create_index("ix_users_last_name", "users", ["last_name"])
+        op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+    if "conversations" not in existing_tables:
+        op.create_table(
+            "conversations",
+            sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("user_id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("start_time", sa.DateTime(), nullable=True),
+            sa.Column("end_time", sa.DateTime(), nullable=True),
+            sa.Column("title", sa.String(), nullable=True),
+            sa.Column("status", sa.String(), nullable=True),
+            sa.Column("selected_document_ids", postgresql.ARRAY(postgresql.UUID(as_uuid=True)), nullable=True),
+            sa.ForeignKeyConstraint(["user_id"], ["users.user_id"]),
+            sa.PrimaryKeyConstraint("id")
+        )
+
+    if "messages" not in existing_tables:
+        op.create_table(
+            "messages",
+            sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("conversation_id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("sender_id", postgresql.UUID(as_uuid=True), nullable=True),
+            sa.Column("content", sa.Text(), nullable=False),
+            sa.Column("llm_model", sa.String(), nullable=False),
+            sa.Column("tokens_generated", sa.Integer(), nullable=True),
+            sa.Column("response_time", sa.Float(), nullable=True),
+            sa.Column("timestamp", sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(["conversation_id"], ["conversations.id"]),
+            sa.ForeignKeyConstraint(["sender_id"], ["users.user_id"]),
+            sa.PrimaryKeyConstraint("id")
+        )
+
+    if "documents" not in existing_tables:
+        op.create_table(
+            "documents",
+            sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("user_id", postgresql.UUID(as_uuid=True), nullable=True),
+            sa.Column("file_name", sa.String(), nullable=False),
+            sa.Column("file_path", sa.String(), nullable=False),
+            sa.Column("upload_time", sa.DateTime(), nullable=True),
+            sa.Column("size", sa.BigInteger(), nullable=False),
+            sa.Column("checksum", sa.String(), nullable=False),
+            sa.ForeignKeyConstraint(["user_id"], ["users.user_id"]),
+            sa.PrimaryKeyConstraint("id")
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("documents")
+    op.drop_table("messages")
+    op.drop_table("conversations")
+    op.drop_index("ix_users_email", table_name="users")
+    op.drop_index("ix_users_last_name", table_name="users")
+    op.drop_index("ix_users_first_name", table_name="users")
+    op.drop_index("ix_users_user_id", table_name="users")
+    op.drop_index("ix_users_id", table_name="users")
+    op.drop_table("users")
+    sa.Enum(name="userrole").drop(op.get_bind())
+    op.drop_index("ix_secret_keys_id", table_name="secret_keys")
+    op.drop_table("secret_keys")
@@ -0,0 +1,127 @@
+"""Conversation document links and query indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-10-15 00:00:00.000000
+
+Moves the selected documents of each conversation from the conversations.selected_document_ids array
+into the conversation_documents table, makes deleting a conversation cascade to its messages, and adds
+the composite indexes the conversation, message and document queries filter on.
+Every step checks the current schema first, since create_all() may already have applied part of it.
+Duplicate uploads of the same file by the same user, which the unique (user_id, checksum) index would reject,
+are merged into the oldest upload first.
+"""
+import logging
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+# Each document paired with the oldest upload of the same file by the same user, which is the one kept
+RANKED_DOCUMENTS = """
+    SELECT id, first_value(id) OVER (PARTITION BY user_id, checksum ORDER BY upload_time, id) AS keep_id
+    FROM documents
+    WHERE user_id IS NOT NULL
+"""
+
+
+def merge_duplicate_documents(bind) -> None:
+    """
+    Moves the conversation links of duplicate documents to the oldest copy and deletes the duplicates.
+    Their files and Chroma chunks are not touched, so their paths are logged for cleanup.
+    """
+    bind.execute(sa.text(f"""
+        INSERT INTO conversation_documents (conversation_id, document_id)
+        SELECT links.conversation_id, ranked.keep_id
+        FROM conversation_documents links
+        JOIN ({RANKED_DOCUMENTS}) ranked ON ranked.id = links.document_id
+        WHERE ranked.id <> ranked.keep_id
+        ON CONFLICT DO NOTHING
+    """))
+    duplicates = bind.execute(sa.text(f"""
+        DELETE FROM documents d
+        USING ({RANKED_DOCUMENTS}) ranked
+        WHERE d.id = ranked.id AND ranked.id <> ranked.keep_id
+        RETURNING d.user_id, d.file_path
+    """)).all()
+    for user_id, file_path in duplicates:
+        logger.warning("Removed duplicate document of user %s; its file %s can be deleted", user_id, file_path)
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table("conversation_documents"):
+        op.create_table(
+            "conversation_documents",
+            sa.Column("conversation_id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("document_id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.ForeignKeyConstraint(["conversation_id"], ["conversations.id"], ondelete="CASCADE"),
+            sa.ForeignKeyConstraint(["document_id"], ["documents.id"], ondelete="CASCADE"),
+            sa.PrimaryKeyConstraint("conversation_id", "document_id")
+        )
+        op.create_index("ix_conversation_documents_document_id", "conversation_documents", ["document_id"])
+
+    conversation_columns = {column["name"] for column in inspector.get_columns("conversations")}
+    if "selected_document_ids" in conversation_columns:
+        # Links to documents that were deleted in the meantime are dropped rather than violating the foreign key
+        op.execute("""
+            INSERT INTO conversation_documents (conversation_id, document_id)
+            SELECT DISTINCT c.id, d.id
+            FROM conversations c
+            CROSS JOIN LATERAL unnest(c.selected_document_ids) AS selected(document_id)
+            JOIN documents d ON d.id = selected.document_id
+            ON CONFLICT DO NOTHING
+        """)
+        op.drop_column("conversations", "selected_document_ids")
+
+    for foreign_key in inspector.get_foreign_keys("messages"):
+        if foreign_key["referred_table"] == "conversations" and \
+                foreign_key.get("options", {}).get("ondelete") != "CASCADE":
+            op.drop_constraint(foreign_key["name"], "messages", type_="foreignkey")
+            op.create_foreign_key(foreign_key["name"], "messages", "conversations", ["conversation_id"], ["id"],
+                                  ondelete="CASCADE")
+
+    indexes = [
+        ("conversations", "ix_conv_user_status", ["user_id", "status"], False),
+        ("messages", "ix_messages_conv_ts", ["conversation_id", "timestamp"], False),
+        ("documents", "ix_doc_user_checksum", ["user_id", "checksum"], True),
+    ]
+    for table, name, columns, unique in indexes:
+        if name not in {index["name"] for index in inspector.get_indexes(table)}:
+            if name == "ix_doc_user_checksum":
+                # Uploads were not checked for duplicates atomically before this index, so a user may have two
+                merge_duplicate_documents(op.get_bind())
+            op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_doc_user_checksum", table_name="documents")
+    op.drop_index("ix_messages_conv_ts", table_name="messages")
+    op.drop_index("ix_conv_user_status", table_name="conversations")
+
+    op.drop_constraint("messages_conversation_id_fkey", "messages", type_="foreignkey")
+    op.create_foreign_key("messages_conversation_id_fkey", "messages", "conversations", ["conversation_id"], ["id"])
+
+    op.add_column("conversations", sa.Column("selected_document_ids", postgresql.ARRAY(postgresql.UUID(as_uuid=True)),
+                                             nullable=True))
+    op.execute("""
+        UPDATE conversations c
+        SET selected_document_ids = links.document_ids
+        FROM (
+            SELECT conversation_id, array_agg(document_id) AS document_ids
+            FROM conversation_documents
+            GROUP BY conversation_id
+        ) links
+        WHERE links.conversation_id = c.id
+    """)
+    op.drop_index("ix_conversation_documents_document_id", table_name="conversation_documents")
+    op.drop_table("conversation_documents")
@@ -0,0 +1,28 @@
+"""Document chunk counts
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2024-10-20 00:00:00.000000
+
+Adds documents.chunk_count, set once a document's chunks are all stored in Chroma.
+Documents indexed before this revision keep a NULL count, so they are never used as a source for copying vectors.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    document_columns = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("documents")}
+    if "chunk_count" not in document_columns:
+        op.add_column("documents", sa.Column("chunk_count", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("documents", "chunk_count")